@@ -2,12 +2,120 @@ import sys,os
 sys.path.append(os.path.dirname(__file__))
 import plx_gpib_ethernet
 import socket
+import select
+import time
+
+#compound replies that must fail to parse in a row before a driver stops sending them
+COMPOUND_FAILURES=3
+
+def compoundReadPower(ps, query, message, parseState=int):
+    """
+    Read voltage, current and output state with one semicolon-joined SCPI message.
+    Returns None if the reply does not hold the three fields, for the caller to fall back to
+    separate queries, and turns compound reads off for ps after COMPOUND_FAILURES such replies.
+    Timeouts are raised: separate queries to a device that is not answering would only time out too.
+    """
+    try:
+        v,i,p=query(message).strip().split(';')
+        power=int(parseState(p)), float(v), float(i)
+    except ValueError:
+        #a reply split over several lines leaves the rest buffered, where the fallback queries would read it
+        discardReplies(ps)
+        ps.compoundFailures=getattr(ps,'compoundFailures',0)+1
+        if ps.compoundFailures>=COMPOUND_FAILURES:
+            ps.compoundQuery=False
+        return None
+    ps.compoundFailures=0
+    return power
+
+#readings the Keithley 2000 buffer holds
+KEITHLEY_BUFFER=1024
+
+def rtdTemperature(resistance):
+    """PT1000 temperature in C from its resistance in ohm, for a float or a NumPy array"""
+    return ((resistance/1000)-1)/0.00385
+
+def keithleyBurst(gpib, samples, interval):
+    """
+    Have the Keithley 2000 addressed on gpib take samples readings, interval seconds apart,
+    into its buffer on its own trigger timer, then fetch them in one binary transfer as a NumPy array.
+    Reads whatever the meter is configured for (ConfigRTD/ConfigReadCurrent); the bus is
+    only used to start the burst and to fetch the buffer.
+    """
+    samples=int(samples)
+    if not 1<=samples<=KEITHLEY_BUFFER:
+        raise ValueError(f'Keithley buffer holds 1 to {KEITHLEY_BUFFER} readings, not {samples}')
+    interval=max(float(interval),1e-3)
+    with gpib.batch():
+        for cmd in (':TRAC:CLE', f':TRAC:POIN {samples}', ':TRAC:FEED SENS', ':TRAC:FEED:CONT NEXT',
+                    ':FORM:ELEM READ', ':FORM:DATA SRE', ':FORM:BORD NORM', ':SAMP:COUN 1', f':TRIG:COUN {samples}',
+                    ':TRIG:SOUR TIM', f':TRIG:TIM {interval}', ':INIT'):
+            gpib.write(cmd)
+    time.sleep(samples*interval)
+    timeout=gpib.timeout
+    #the last readings may still be converting, *OPC? answers once the burst is done
+    gpib.set_timeout(3)
+    try:
+        gpib.query('*OPC?')
+        #single precision, big endian, the same layout as REAL,32; the 2000 sends it as an
+        #indefinite length #0 block, so the length has to come from the number of samples
+        data=gpib.query_array(':TRAC:DATA?', 'REAL,32', count=samples)
+    finally:
+        gpib.set_timeout(timeout)
+        #back to one reading per :READ?
+        with gpib.batch():
+            for cmd in (':TRAC:FEED:CONT NEV', ':FORM:DATA ASC', ':TRIG:SOUR IMM', ':TRIG:COUN 1'):
+                gpib.write(cmd)
+    return data.astype(float)
+
+def cachedQuery(ps, key, read):
+    """
+    Reply to a query that only changes when this driver sets it (*IDN?, limits, sense mode),
+    from the response cache of ps, calling read() to fill it on the first use
+    """
+    cache=ps.responseCache()
+    if key not in cache:
+        cache[key]=read()
+    return cache[key]
+
+def invalidate(ps, key):
+    """Forget a cached reply, before sending the setter that changes it"""
+    ps.responseCache().pop(key, None)
+
+#cached replies that survive a reconnect, the instrument at an address does not change
+STATIC_QUERIES=('ID',)
+
+def reconnected(cache):
+    """What a response cache keeps over a reconnect, other clients may have changed the settings meanwhile"""
+    return {key: cache[key] for key in STATIC_QUERIES if key in cache}
+
+def gpibSession(host, auto=False):
+    """
+    Open one Prologix connection that the drivers for several GPIB addresses behind the
+    same controller can share, by passing it to them as gpib=
+    auto=True turns on the controller's read-after-write, saving the ++read of every query
+    """
+    gpib = plx_gpib_ethernet.PrologixGPIBEthernet(host=host, auto=auto)
+    gpib.connect()
+    return gpib
 
 class gpibControl:
-    def __init__(self, host, addr):
-        self.gpib = plx_gpib_ethernet.PrologixGPIBEthernet(host=host)
-        self.gpib.connect()
+    #(min, max) voltage SetLimits will accept
+    SAFE_VOLTAGE=(0.6,1.5)
+    def __init__(self, host, addr, gpib=None):
+        if gpib is None:
+            gpib = gpibSession(host)
+        self.gpib = gpib
         self.addr=addr
+        self.cache={}
+        self.cacheConnection=gpib.connections
+
+    def responseCache(self):
+        #the connection may be shared and reopened without this driver knowing
+        if self.cacheConnection!=self.gpib.connections:
+            self.cache=reconnected(self.cache)
+            self.cacheConnection=self.gpib.connections
+        return self.cache
 
     def close(self):
         self.gpib.close()
@@ -19,6 +127,7 @@ class gpibControl:
         self.gpib.reconnect()
 
     def disconnect(self):
+        self.select()
         self.gpib.disconnect()
 
     def select(self):
@@ -26,8 +135,10 @@ class gpibControl:
             self.gpib.select(self.addr)
 
     def ID(self):
-        self.select()
-        return self.gpib.query("*IDN?")[:-1]
+        def read():
+            self.select()
+            return self.gpib.query("*IDN?")[:-1]
+        return cachedQuery(self, 'ID', read)
 
     def testQuery(self,q):
         self.select()
@@ -35,12 +146,17 @@ class gpibControl:
 
 class SiglentSPD1168X:
     PORT=5025
+    SAFE_VOLTAGE=(0.6,1.5)
+    compoundQuery=True
     def __init__(self, ip, timeout=1):
         self.host = ip
         self.socket = socket.socket(socket.AF_INET,
                                     socket.SOCK_STREAM,
                                     socket.IPPROTO_TCP)
         self.socket.settimeout(timeout)
+        self.timeout = timeout
+        self.reader = plx_gpib_ethernet.TerminatedReader()
+        self.cache = {}
         self.connect()
 
     def connect(self):
@@ -48,9 +164,12 @@ class SiglentSPD1168X:
 
     def reconnect(self):
         self.socket.close()
+        self.reader.clear()
+        self.cache = reconnected(self.cache)
         self.socket = socket.socket(socket.AF_INET,
                                     socket.SOCK_STREAM,
                                     socket.IPPROTO_TCP)
+        self.socket.settimeout(self.timeout)
         self.socket.connect((self.host, self.PORT))
 
     def disconnect(self):
@@ -61,15 +180,24 @@ class SiglentSPD1168X:
         self.socket.close()
         return
 
+    def responseCache(self):
+        return self.cache
+
     def ID(self):
-        return self.query('*IDN?')[:-1]
+        return cachedQuery(self, 'ID', lambda: self.query('*IDN?')[:-1])
 
     def Set4Wire(self):
+        invalidate(self, 'sense')
         self.write('MOE:SET 4W')
 
     def Set2Wire(self):
+        invalidate(self, 'sense')
         self.write('MOE:SET 2W')
 
+    def ReadSense(self):
+        """'4W' or '2W', bit 5 of the status register"""
+        return cachedQuery(self, 'sense', lambda: '4W' if (int(self.query("SYST:STAT?")[:-1],16)>>5)&1 else '2W')
+
     def query(self, cmd, buffer_size=1024*1024):
         self.write(cmd)
         return self.read(buffer_size)
@@ -85,8 +213,7 @@ class SiglentSPD1168X:
         self.socket.send(encoded_value)
 
     def _recv(self, byte_num):
-        value = self.socket.recv(byte_num)
-        return value.decode('ascii')
+        return self.reader.readline(self.socket)
 
     def IsOn(self):
         stat=int(self.query("SYST:STAT?")[:-1],16)
@@ -99,6 +226,11 @@ class SiglentSPD1168X:
         self.write("OUTP CH1,OFF")
 
     def ReadPower(self):
+        if self.compoundQuery:
+            power=compoundReadPower(self, self.query, "MEAS:VOLT?;:MEAS:CURR?;:SYST:STAT?",
+                                    parseState=lambda stat: (int(stat,16)>>4)&1)
+            if power is not None:
+                return power
         v=self.query(f"MEAS:VOLT?")[:-1]
         i=self.query(f"MEAS:CURR?")[:-1]
         p=self.IsOn()
@@ -108,25 +240,41 @@ class SiglentSPD1168X:
             return -1, -1, -1
 
     def ReadLimits(self):
-        v=self.query(f"VOLT?")[:-1]
-        i=self.query(f"CURR?")[:-1]
-        return float(v),float(i)
+        def read():
+            v=self.query(f"VOLT?")[:-1]
+            i=self.query(f"CURR?")[:-1]
+            return float(v),float(i)
+        return cachedQuery(self, 'limits', read)
 
     def SetLimits(self, voltage, current):
-        if voltage >= 0.6 and voltage<=1.5:
+        if voltage >= self.SAFE_VOLTAGE[0] and voltage<=self.SAFE_VOLTAGE[1]:
+            invalidate(self, 'limits')
             self.write(f"VOLT {voltage}")
             self.write(f"CURR {current}")
         else:
-            print(f'Selected voltage ({voltage}) outside of defined safe range 0.6-1.5')
+            print(f'Selected voltage ({voltage}) outside of defined safe range {self.SAFE_VOLTAGE[0]}-{self.SAFE_VOLTAGE[1]}')
             return False
 
-class Agilent3648A(gpibControl):
-    def __init__(self, host, addr):
-        gpibControl.__init__(self, host, addr)
-        #check we have the correct ID for Agilent 3648A
-        modelID=self.ID()
-        expectedModel='Agilent Technologies,E3648A,0,1.7-5.0-1.0'
-        assert modelID==expectedModel, f"Incorrect Model for Addr {addr}\nRead:     {modelID}\nExpected: {expectedModel}"
+class AgilentSupply(gpibControl):
+    """
+    Agilent/HP E36xx bench supplies, which share one SCPI command set
+    Each model is a subclass giving the start of its *IDN? reply and its number of outputs;
+    on multi-output models every command is preceded by INST:SEL of the output
+    """
+    compoundQuery=True
+    ID_PREFIX=None
+    OUTPUTS=1
+
+    def __init__(self, host, addr, gpib=None, modelID=None):
+        gpibControl.__init__(self, host, addr, gpib)
+        #check we have the correct ID, reusing the reply getPowerSupply already read
+        if modelID is None:
+            modelID=self.ID()
+        self.responseCache()['ID']=modelID
+        assert modelID.startswith(self.ID_PREFIX), f"Incorrect Model for Addr {addr}\nRead:     {modelID}\nExpected: {self.ID_PREFIX}..."
+
+    def _output(self, output, separator='\n'):
+        return f"INST:SEL OUT{output}{separator}" if self.OUTPUTS>1 else ''
 
     def IsOn(self):
         self.select()
@@ -142,41 +290,54 @@ class Agilent3648A(gpibControl):
 
     def ReadPower(self, output=1):
         self.select()
-        v=self.gpib.query(f"INST:SEL OUT{output}\nMEAS:VOLT?")[:-1]
-        i=self.gpib.query(f"INST:SEL OUT{output}\nMEAS:CURR?")[:-1]
+        if self.compoundQuery:
+            power=compoundReadPower(self, self.gpib.query, f"{self._output(output, ';:')}MEAS:VOLT?;:MEAS:CURR?;:OUTP:STAT?")
+            if power is not None:
+                return power
+        v=self.gpib.query(f"{self._output(output)}MEAS:VOLT?")[:-1]
+        i=self.gpib.query(f"{self._output(output)}MEAS:CURR?")[:-1]
         p=self.gpib.query("OUTP:STAT?")[:-1]
         try:
             return int(p), float(v),float(i)
         except:
             return -1, -1, -1
 
+    def ReadLimits(self, output=1):
+        def read():
+            self.select()
+            v=self.gpib.query(f"{self._output(output)}VOLT?")[:-1]
+            i=self.gpib.query(f"{self._output(output)}CURR?")[:-1]
+            return float(v),float(i)
+        return cachedQuery(self, ('limits', output), read)
+
+    def SetLimits(self, voltage, current, output=1):
+        if voltage >= self.SAFE_VOLTAGE[0] and voltage<=self.SAFE_VOLTAGE[1]:
+            invalidate(self, ('limits', output))
+            with self.gpib.batch():
+                self.select()
+                self.gpib.write(f"{self._output(output)}VOLT {voltage}")
+                self.gpib.write(f"{self._output(output)}CURR {current}")
+        else:
+            print(f'Selected voltage ({voltage}) outside of defined safe range {self.SAFE_VOLTAGE[0]}-{self.SAFE_VOLTAGE[1]}')
+            return False
+
+
+class Agilent3648A(AgilentSupply):
+    ID_PREFIX='Agilent Technologies,E3648A,'
+    OUTPUTS=2
+
     def ReadPower_1(self):
         return self.ReadPower(1)
 
     def ReadPower_2(self):
         return self.ReadPower(2)
 
-    def ReadLimits(self, output=1):
-        self.select()
-        v=self.gpib.query(f"INST:SEL OUT{output}\nVOLT?")[:-1]
-        i=self.gpib.query(f"INST:SEL OUT{output}\nCURR?")[:-1]
-        return float(v),float(i)
-
     def ReadLimits_1(self):
         return self.ReadLimits(1)
 
     def ReadLimits_2(self):
         return self.ReadLimits(2)
 
-    def SetLimits(self, voltage, current, output=1):
-        if voltage >= 0.6 and voltage<=1.5:
-            self.select()
-            self.gpib.write(f"INST:SEL OUT{output}\nVOLT {voltage}")
-            self.gpib.write(f"INST:SEL OUT{output}\nCURR {current}")
-        else:
-            print(f'Selected voltage ({voltage}) outside of defined safe range 0.6-1.5')
-            return False
-
     def SetLimits_1(self,v=1.2,i=0.6):
         self.SetLimits(output=1, voltage=v, current=i)
 
@@ -184,122 +345,41 @@ class Agilent3648A(gpibControl):
         self.SetLimits(output=2, voltage=v, current=i)
 
 
-class Agilent3642A(gpibControl):
-    def __init__(self, host, addr):
-        gpibControl.__init__(self, host, addr)
-        #check we have the correct ID for Agilent 3642AA
-        modelID=self.ID()
-        expectedModel='Agilent Technologies,E3642A,0,1.6-5.0-1.0'
-        assert modelID==expectedModel, f"Incorrect Model for Addr {addr}\nRead:     {modelID}\nExpected: {expectedModel}"
+class Agilent3642A(AgilentSupply):
+    ID_PREFIX='Agilent Technologies,E3642A,'
 
-    def IsOn(self):
-        self.select()
-        return self.gpib.query("OUTP:STAT?")[:-1]
 
-    def TurnOn(self):
-        self.select()
-        self.gpib.write("OUTP ON")
-
-    def TurnOff(self):
-        self.select()
-        self.gpib.write("OUTP OFF")
-
-    def ReadPower(self):
-        self.select()
-        v=self.gpib.query(f"MEAS:VOLT?")[:-1]
-        i=self.gpib.query(f"MEAS:CURR?")[:-1]
-        p=self.gpib.query("OUTP:STAT?")[:-1]
-        try:
-            return int(p), float(v),float(i)
-        except:
-            return -1, -1, -1
-
-    def ReadLimits(self):
-        self.select()
-        v=self.gpib.query(f"VOLT?")[:-1]
-        i=self.gpib.query(f"CURR?")[:-1]
-        return float(v),float(i)
-
-    def SetLimits(self, voltage, current):
-        if voltage >= 0.6 and voltage<=1.5:
-            self.select()
-            self.gpib.write(f"VOLT {voltage}")
-            self.gpib.write(f"CURR {current}")
-        else:
-            print(f'Selected voltage ({voltage}) outside of defined safe range 0.6-1.5')
-            return False
-
-
-class Agilent3633A(gpibControl):
-    def __init__(self, host, addr):
-        gpibControl.__init__(self, host, addr)
-        #check we have the correct ID for Agilent 3633A
-        modelID=self.ID()
-        expectedModel='HEWLETT-PACKARD,E3633A,0,1.7-5.0-1.0'
-        assert modelID==expectedModel, f"Incorrect Model for Addr {addr}\nRead:     {modelID}\nExpected: {expectedModel}"
-
-    def IsOn(self):
-        self.select()
-        return self.gpib.query("OUTP:STAT?")[:-1]
-
-    def TurnOn(self):
-        self.select()
-        self.gpib.write("OUTP ON")
-
-    def TurnOff(self):
-        self.select()
-        self.gpib.write("OUTP OFF")
-
-    def ReadPower(self):
-        self.select()
-        v=self.gpib.query(f"MEAS:VOLT?")[:-1]
-        i=self.gpib.query(f"MEAS:CURR?")[:-1]
-        p=self.gpib.query("OUTP:STAT?")[:-1]
-        try:
-            return int(p), float(v),float(i)
-        except:
-            return -1, -1, -1
-
-    def ReadLimits(self):
-        self.select()
-        v=self.gpib.query(f"VOLT?")[:-1]
-        i=self.gpib.query(f"CURR?")[:-1]
-        return float(v),float(i)
-
-    def SetLimits(self, voltage, current):
-        if voltage >= 0.6 and voltage<=1.5:
-            self.select()
-            self.gpib.write(f"VOLT {voltage}")
-            self.gpib.write(f"CURR {current}")
-        else:
-            print(f'Selected voltage ({voltage}) outside of defined safe range 0.6-1.5')
-            return False
+class Agilent3633A(AgilentSupply):
+    ID_PREFIX='HEWLETT-PACKARD,E3633A,'
 
 
 
 class ObelixSupplies(gpibControl):
+    SAFE_VOLTAGE=(0.9,1.5)
+
     def select_addr(self, addr):
         self.gpib.select(addr)
 
     def SetVoltage(self, voltage):
         self.select_addr(6)
 
-        if float(voltage)<=1.5 and float(voltage) >= 0.9:
+        if float(voltage)<=self.SAFE_VOLTAGE[1] and float(voltage) >= self.SAFE_VOLTAGE[0]:
             self.gpib.write(f"V {voltage}")
             return True
         else:
-            print(f'Selected voltage ({voltage}) outside of defined safe range 0.9-1.5')
+            print(f'Selected voltage ({voltage}) outside of defined safe range {self.SAFE_VOLTAGE[0]}-{self.SAFE_VOLTAGE[1]}')
             return False
 
     def SetLimits(self, voltage, current=0.6):
         self.select_addr(6)
 
-        if float(voltage)<=1.5 and float(voltage) >= 0.9:
-            self.gpib.write(f"V {voltage}")
-            self.gpib.write(f"I {current}")
+        if float(voltage)<=self.SAFE_VOLTAGE[1] and float(voltage) >= self.SAFE_VOLTAGE[0]:
+            with self.gpib.batch():
+                self.gpib.write(f"V {voltage}")
+                self.gpib.write(f"I {current}")
             return True
         else:
-            print(f'Selected voltage ({voltage}) outside of defined safe range 0.9-1.5')
+            print(f'Selected voltage ({voltage}) outside of defined safe range {self.SAFE_VOLTAGE[0]}-{self.SAFE_VOLTAGE[1]}')
             return False
 
     def ASICOn(self,voltage=None):
@@ -312,8 +392,9 @@ class ObelixSupplies(gpibControl):
             is_set=self.SetVoltage(float(voltage))
 
         if is_set:
-            self.gpib.write("I 0.6")
-            self.gpib.write("OP 1")
+            with self.gpib.batch():
+                self.gpib.write("I 0.6")
+                self.gpib.write("OP 1")
 
     def ASICOff(self):
         self.select_addr(6)
@@ -340,9 +421,15 @@ class ObelixSupplies(gpibControl):
         self.select_addr(14)
         resistance=float(self.gpib.query(":READ?"))
 #        resistance=float(self.gpib.read()[:-1])
-        temperature=((resistance/1000)-1)/0.00385
+        temperature=rtdTemperature(resistance)
         return temperature, resistance
 
+    def burstRTD(self, samples, interval=0.1):
+        """Temperatures and resistances of samples readings interval seconds apart, as NumPy arrays"""
+        self.select_addr(14)
+        resistance=keithleyBurst(self.gpib, samples, interval)
+        return rtdTemperature(resistance), resistance
+
     def ConfigReadCurrent(self):
         self.select_addr(14)
         self.gpib.write("*RST")
@@ -354,6 +441,11 @@ class ObelixSupplies(gpibControl):
         current=float(self.gpib.query(":READ?"))
         return current
 
+    def burstCurrent(self, samples, interval=0.1):
+        """Currents of samples readings interval seconds apart, as a NumPy array"""
+        self.select_addr(14)
+        return keithleyBurst(self.gpib, samples, interval)
+
 class ObelixRTD(gpibControl):
     def select_addr(self, addr):
         self.gpib.select(addr)
@@ -367,11 +459,19 @@ class ObelixRTD(gpibControl):
     def readRTD(self):
         self.select_addr(14)
         resistance=float(self.gpib.query(":READ?"))
-        temperature=((resistance/1000)-1)/0.00385
+        temperature=rtdTemperature(resistance)
         return temperature, resistance
 
+    def burstRTD(self, samples, interval=0.1):
+        """Temperatures and resistances of samples readings interval seconds apart, as NumPy arrays"""
+        self.select_addr(14)
+        resistance=keithleyBurst(self.gpib, samples, interval)
+        return rtdTemperature(resistance), resistance
+
 class ObelixPower:
-    def __init__(self, ip, gpib_ip, timeout=1):
+    SAFE_VOLTAGE=(0.6,1.5)
+    OUTPUTS=3
+    def __init__(self, ip, gpib_ip, timeout=1, gpib=None):
         self.host = ip
         self.PORT = 9221
         self.gpib_ip = gpib_ip
@@ -379,9 +479,12 @@ class ObelixPower:
                                     socket.SOCK_STREAM,
                                     socket.IPPROTO_TCP)
         self.socket.settimeout(timeout)
+        self.timeout = timeout
+        self.reader = plx_gpib_ethernet.TerminatedReader()
+        self.cache = {}
         self.connect()
         try:
-                self.gpib = gpibControl(gpib_ip,14)
+            self.gpib = gpibControl(gpib_ip,14,gpib)
         except:
             self.gpib = None
 
@@ -390,9 +493,12 @@ class ObelixPower:
 
     def reconnect(self):
         self.socket.close()
+        self.reader.clear()
+        self.cache = reconnected(self.cache)
         self.socket = socket.socket(socket.AF_INET,
                                     socket.SOCK_STREAM,
                                     socket.IPPROTO_TCP)
+        self.socket.settimeout(self.timeout)
         self.socket.connect((self.host, self.PORT))
 
     def disconnect(self):
@@ -403,8 +509,11 @@ class ObelixPower:
         self.socket.close()
         return
 
+    def responseCache(self):
+        return self.cache
+
     def ID(self):
-        return self.query('*IDN?')[:-1]
+        return cachedQuery(self, 'ID', lambda: self.query('*IDN?')[:-1])
 
     def query(self, cmd, buffer_size=1024*1024):
         self.write(cmd)
@@ -421,8 +530,7 @@ class ObelixPower:
         self.socket.send(encoded_value)
 
     def _recv(self, byte_num):
-        value = self.socket.recv(byte_num)
-        return value.decode('ascii')
+        return self.reader.readline(self.socket)
 
     def IsOn(self,channel=1):
         p = int(self.query(f"OP{channel}?")[:-2])
@@ -444,16 +552,19 @@ class ObelixPower:
             return -1, -1, -1
 
     def ReadLimits(self,channel=1):
-        v=self.query(f"V{channel}?")[3:-2]
-        i=self.query(f"I{channel}?")[3:-2]
-        return float(v),float(i)
+        def read():
+            v=self.query(f"V{channel}?")[3:-2]
+            i=self.query(f"I{channel}?")[3:-2]
+            return float(v),float(i)
+        return cachedQuery(self, ('limits', channel), read)
 
     def SetLimits(self, voltage, current,channel=1):
-        if voltage >= 0.6 and voltage<=1.5:
+        if voltage >= self.SAFE_VOLTAGE[0] and voltage<=self.SAFE_VOLTAGE[1]:
+            invalidate(self, ('limits', channel))
             self.write(f"V{channel} {voltage}")
             self.write(f"I{channel} {current}")
         else:
-            print(f'Selected voltage ({voltage}) outside of defined safe range 0.6-1.5')
+            print(f'Selected voltage ({voltage}) outside of defined safe range {self.SAFE_VOLTAGE[0]}-{self.SAFE_VOLTAGE[1]}')
             return False
 
     def ConfigReadCurrent(self):
@@ -468,22 +579,82 @@ class ObelixPower:
             current = self.query(f"I1O?")[:-3]
         return current
 
+    def burstCurrent(self, samples, interval=0.1):
+        """Currents of samples readings interval seconds apart from the Keithley, as a NumPy array"""
+        self.gpib.select()
+        return keithleyBurst(self.gpib.gpib, samples, interval)
+
 
 knownModelTypes=['Agilent Technologies,E3648A,0,1.7-5.0-1.0',
                  'Agilent Technologies,E3642A,0,1.6-5.0-1.0',
                  'HEWLETT-PACKARD,E3633A,0,1.7-5.0-1.0']
 
-def getPowerSupply(ip, addr):
-    ps=gpibControl(ip,addr)
-    model=ps.ID()
-    ps.disconnect()
-    ps.close()
-
-    assert model in knownModelTypes
-
-    if model=='Agilent Technologies,E3648A,0,1.7-5.0-1.0':
-        return Agilent3648A(ip,addr)
-    if model=='Agilent Technologies,E3642A,0,1.6-5.0-1.0':
-        return Agilent3642A(ip,addr)
-    if model=='HEWLETT-PACKARD,E3633A,0,1.7-5.0-1.0':
-        return Agilent3633A(ip,addr)
+#*IDN? reply, or the start of one to cover firmware revisions, and the driver to build for it
+modelRegistry={}
+
+def registerModel(idPrefix, driver):
+    modelRegistry[idPrefix]=driver
+
+for driver in (Agilent3648A, Agilent3642A, Agilent3633A):
+    registerModel(driver.ID_PREFIX, driver)
+
+def driverFor(modelID):
+    """Driver class for an *IDN? reply, matching the longest registered prefix, or None"""
+    matches=[prefix for prefix in modelRegistry if modelID.startswith(prefix)]
+    if not matches:
+        return None
+    return modelRegistry[max(matches, key=len)]
+
+def getPowerSupply(ip, addr, gpib=None):
+    """
+    Identify the supply at gpib address addr with one *IDN? and build its driver on the same
+    connection (gpib if given, otherwise a new session that the driver keeps)
+    """
+    ownSession=gpib is None
+    if ownSession:
+        gpib=gpibSession(ip)
+    try:
+        gpib.select(addr)
+        model=gpib.query("*IDN?")[:-1]
+        driver=driverFor(model)
+        assert driver is not None, f"Unknown model at Addr {addr}: {model}"
+        return driver(ip,addr,gpib,modelID=model)
+    except:
+        if ownSession:
+            gpib.close()
+        raise
+
+
+def discardReplies(ps):
+    """
+    Drop whatever is buffered or waiting on the connection of ps, after a timeout or a reply that
+    could not be parsed, so that a late reply is not taken as the answer to the next query
+    """
+    conn=ps.gpib if isinstance(ps, gpibControl) else ps
+    if hasattr(conn, 'reader'):
+        conn.reader.clear()
+    while select.select([conn.socket],[],[],0)[0]:
+        if conn.socket.recv(4096)==b'':
+            raise ConnectionError('Connection closed by instrument')
+
+def ReadPowerAll(supplies):
+    """
+    Read power from several supplies in one pass, e.g. all the drivers sharing a gpibSession
+    Takes {addr: driver} and returns {addr: {'power': [p,v,i], 'time': t}}, with power [-1,-1,-1]
+    and an 'error' entry for supplies that could not be read
+    Socket errors other than timeouts are raised, since the session itself needs reopening
+    """
+    results={}
+    for addr,ps in supplies.items():
+        try:
+            power=list(ps.ReadPower())
+            results[addr]={'power':power,'time':time.time()}
+        except socket.timeout:
+            results[addr]={'power':[-1,-1,-1],'time':time.time(),'error':'timed out'}
+            #the supplies after it may share its connection
+            discardReplies(ps)
+        except OSError:
+            raise
+        except Exception as e:
+            results[addr]={'power':[-1,-1,-1],'time':time.time(),'error':str(e)}
+    return results
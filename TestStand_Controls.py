@@ -1,4 +1,6 @@
 from time import sleep
+import time
+import logging
 
 GPIBAddresses={46:6,
               48:8,
@@ -6,7 +8,45 @@ GPIBAddresses={46:6,
               15:15,
               }
 
-from PowerSupplyControls import getPowerSupply
+from PowerSupplyControls import getPowerSupply, gpibSession, gpibControl, ReadPowerAll
+
+
+def monitorPower(supplies, period, record):
+    """
+    Read every supply in {board: ps} once per period, on the fixed schedule start+k*period so
+    the time spent reading does not add up as drift
+    When a pass overruns the next deadline, the missed slots are reported and skipped rather
+    than read back to back
+    record(board, t, p, v, i) is called for every reading; a board that cannot be read is
+    logged and skipped, and a lost connection is reopened for the next pass
+    """
+    start=time.monotonic()
+    k=0
+    while True:
+        delay=start+k*period-time.monotonic()
+        if delay>0:
+            sleep(delay)
+        try:
+            results=ReadPowerAll(supplies)
+        except OSError as e:
+            logging.error(f'Connection lost ({e}), reconnecting')
+            results={}
+            #boards on one gpib controller share its connection
+            connections={id(ps.gpib) if isinstance(ps, gpibControl) else id(ps):ps for ps in supplies.values()}
+            for ps in connections.values():
+                try:
+                    ps.reconnect()
+                except OSError as e:
+                    logging.error(f'Reconnect failed ({e}), trying again next pass')
+        for board,result in results.items():
+            if 'error' in result or result['power']==[-1,-1,-1]:
+                logging.error(f'Board {board}: could not read power ({result.get("error", "bad reply")})')
+            else:
+                record(board, result['time'], *result['power'])
+        nextSlot=max(k+1, int((time.monotonic()-start)/period)+1)
+        if nextSlot>k+1:
+            logging.warning(f'Reading took {time.monotonic()-start-k*period:.3f} s, missed {nextSlot-k-1} deadline(s) of the {period} s schedule')
+        k=nextSlot
 
 
 if __name__=='__main__':
@@ -22,14 +62,39 @@ if __name__=='__main__':
     parser.add_argument('--logging', default=False, action='store_true', help='Start power monitoring')
     parser.add_argument('--setVoltage', default=None, type=float, help='Voltage setting (1.2 V if left unset)')
     parser.add_argument('--logName', default='logFile.log', help='log name')
-    parser.add_argument('--time', default=15, type=float,help='Frequency (in seconds) of how often to read the power')
+    parser.add_argument('--binaryLog', default=None, help='Also append readings to this binary power log (see powerlog.py)')
+    parser.add_argument('--time', default=15, type=float,help='Frequency (in seconds, fractions allowed) of how often to read the power')
     parser.add_argument('--ip', default='192.168.1.50', help='IP Address of the gpib controller')
     parser.add_argument('--addr', default=8, type=int, choices=[4,6,8],help='GPIB address of the power supply')
     parser.add_argument('--board', default=46, type=int, help='Board number of hexacontroller (used to determing which power supply to control)')
+    parser.add_argument('--boards', default=None, type=int, nargs='+', choices=list(GPIBAddresses), help='Monitor the power supplies of several boards (looked up in GPIBAddresses) over one controller session')
+    parser.add_argument('--subscribe', default=None, help='Log readings published by gpib_server (e.g. tcp://localhost:5561) for --board instead of reading the power supply')
 
     args = parser.parse_args()
 
-    ps=getPowerSupply(args.ip,args.addr)
+    if args.subscribe is not None:
+        #readings come from gpib_server, there is no supply connection to send commands on
+        conflicting=[option for option,used in (('--On',args.On), ('--Off',args.Off), ('--id',args.id), ('--read',args.read),
+                                                ('--disconnect',args.disconnect), ('--setVoltage',args.setVoltage is not None),
+                                                ('--boards',args.boards is not None)) if used]
+        if conflicting:
+            parser.error(f'--subscribe cannot be combined with {", ".join(conflicting)}')
+
+    if args.boards is not None:
+        #--boards is for monitoring only, the other commands act on a single supply
+        conflicting=[option for option,used in (('--On',args.On), ('--Off',args.Off), ('--id',args.id), ('--read',args.read),
+                                                ('--disconnect',args.disconnect), ('--setVoltage',args.setVoltage is not None)) if used]
+        if conflicting:
+            parser.error(f'--boards cannot be combined with {", ".join(conflicting)}, use --board for those')
+
+    if args.boards is not None:
+        gpib=gpibSession(args.ip)
+        supplies={board:getPowerSupply(args.ip,GPIBAddresses[board],gpib) for board in args.boards}
+    elif args.subscribe is None:
+        ps=getPowerSupply(args.ip,args.addr)
+        supplies={args.board:ps}
+    else:
+        supplies={args.board:None}
 
     if args.On:
         ps.SetLimits_2(v=0,i=0.6)
@@ -58,8 +123,6 @@ if __name__=='__main__':
         p,v,i=ps.ReadPower()
         print(f'Power: {"On" if int(p) else "Off"}, Voltage: {float(v):.4f} V, Current: {float(i):.4f} A')
     if args.logging:
-        import logging
-        import time
         logging.basicConfig(filename=args.logName,
                             level=logging.INFO,
                             format='%(asctime)4s %(message)s',
@@ -70,13 +133,39 @@ if __name__=='__main__':
         console.setFormatter(formatter)
         logging.getLogger().addHandler(console)
 
+        binaryLog=None
+        if args.binaryLog is not None:
+            from powerlog import PowerLogWriter
+            binaryLog=PowerLogWriter(args.binaryLog)
+
+        def record(board, t, p, v_ASIC, i_ASIC):
+            if binaryLog is not None:
+                binaryLog.write(board, int(p), float(v_ASIC), float(i_ASIC), t)
+            prefix=f'Board {board} ' if len(supplies)>1 else ''
+            logging.info(f'{prefix}Power: {"On" if int(p) else "Off"}, ASIC Voltage: {float(v_ASIC):.4f}, ASIC Current:{float(i_ASIC):.4f}')
+
         try:
-            while True:
-                p,v_ASIC,i_ASIC=ps.ReadPower()
-                logging.info(f'Power: {"On" if int(p) else "Off"}, ASIC Voltage: {float(v_ASIC):.4f}, ASIC Current:{float(i_ASIC):.4f}')
-                sleep(args.time)
+            if args.subscribe is None:
+                monitorPower(supplies, args.time, record)
+            else:
+                import zmq
+                from telemetry import unpackSample
+                subscriber = zmq.Context().socket(zmq.SUB)
+                subscriber.connect(args.subscribe)
+                subscriber.setsockopt(zmq.SUBSCRIBE, str(args.board).encode())
+                while True:
+                    topic,frame=subscriber.recv_multipart()
+                    #subscriptions match on prefix, so '4' would also get '46'
+                    if topic.decode()!=str(args.board):
+                        continue
+                    t,p,v_ASIC,i_ASIC=unpackSample(frame)
+                    if binaryLog is not None:
+                        binaryLog.write(args.board, p, v_ASIC, i_ASIC, t)
+                    logging.info(f'Power: {"On" if int(p) else "Off"}, ASIC Voltage: {float(v_ASIC):.4f}, ASIC Current:{float(i_ASIC):.4f}')
         except KeyboardInterrupt:
             logging.info(f'Closing')
+        if binaryLog is not None:
+            binaryLog.close()
 
     if args.disconnect:
         ps.disconnect()
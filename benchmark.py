@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+"""
+Latency and throughput benchmarks for the drivers and gpib_server, run against
+instrument_simulator so numbers are reproducible without lab hardware.
+
+    python benchmark.py --output results.json
+    python benchmark.py --compare results.json
+
+Each scenario reports p50/p95/p99 latency, throughput and instrument bus transactions
+per request.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import subprocess
+from instrument_simulator import Simulator, SimulatedSupply, SimulatedKeithley, AGILENT_IDS
+from PowerSupplyControls import getPowerSupply, gpibSession
+
+CONTROLLERS = {'127.0.0.50': {2: 'E3648A', 3: 'E3642A', 4: 'E3633A'},
+               '127.0.0.51': {6: 'E3648A', 8: 'E3642A'}}
+ADDRESSES = ['42','43','44','46','48']
+DEAD_ADDRESS = '48'
+
+def makeSimulator(latency, jitter):
+    sim = Simulator(latency, jitter, seed=1)
+    for host,devices in CONTROLLERS.items():
+        sim.addPrologix(host, {addr: SimulatedSupply(AGILENT_IDS[model], outputs=2 if model=='E3648A' else 1)
+                               for addr,model in devices.items()} | {14: SimulatedKeithley()})
+    return sim
+
+def hostOf(addr):
+    return next(host for host,devices in CONTROLLERS.items() if int(addr[-1]) in devices)
+
+def transactions(sim):
+    return sum(c['writes']+c['reads']+c['controller'] for c in sim.counters.values())
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values)-1, int(round(q/100.*(len(values)-1))))]
+
+def summarize(latencies, elapsed, busTransactions, errors=0):
+    n = len(latencies)
+    return {'requests': n,
+            'errors': errors,
+            'throughput': n/elapsed if elapsed > 0 else float('nan'),
+            'p50_ms': percentile(latencies, 50)*1e3,
+            'p95_ms': percentile(latencies, 95)*1e3,
+            'p99_ms': percentile(latencies, 99)*1e3,
+            'bus_per_request': busTransactions/n if n else float('nan')}
+
+
+def benchDriver(sim, requests, auto=False):
+    """
+    ReadPower straight through the driver classes, all supplies on one shared session per controller,
+    with auto the sessions use the controller's read-after-write
+    """
+    supplies = []
+    for host,devices in CONTROLLERS.items():
+        gpib = gpibSession(host, auto)
+        supplies += [getPowerSupply(host, addr, gpib) for addr in devices if addr != 14]
+    before = transactions(sim)
+    latencies = []
+    start = time.perf_counter()
+    for k in range(requests):
+        t = time.perf_counter()
+        supplies[k % len(supplies)].ReadPower()
+        latencies.append(time.perf_counter()-t)
+    result = summarize(latencies, time.perf_counter()-start, transactions(sim)-before)
+    for ps in supplies:
+        ps.close()
+    return result
+
+
+class ServerProcess:
+    """gpib_server running against the simulator in a scratch directory"""
+    def __init__(self, port, extraArgs=()):
+        self.port = port
+        self.dir = tempfile.mkdtemp(prefix='gpib_bench_')
+        server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gpib_server.py')
+        self.process = subprocess.Popen([sys.executable, server, '--port', str(port), '--pub-port', '',
+                                         '--controllers', *CONTROLLERS, '--siglent-ip', '127.0.0.1{addr}',
+                                         '--addresses', *ADDRESSES, *extraArgs],
+                                        cwd=self.dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def waitReady(self, timeout=30):
+        import zmq
+        socket = zmq.Context.instance().socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(f'tcp://localhost:{self.port}')
+        socket.send_string(f'{ADDRESSES[0]}:::ID')
+        ready = socket.poll(timeout*1000)
+        socket.close()
+        if not ready:
+            raise RuntimeError('gpib_server did not start')
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def benchServer(sim, port, clients, supplies, requests, writeFraction=0., deadDevice=False):
+    """
+    clients REQ sockets each sending requests messages, spread over the first supplies addresses.
+    writeFraction of the messages are SetVoltage instead of ReadPower.  With deadDevice the
+    supply at DEAD_ADDRESS stops answering and only the other supplies' latencies are reported.
+    """
+    import zmq
+    addrs = ADDRESSES[:supplies]
+    if deadDevice:
+        sim_devices = [e for e in sim.endpoints if e[0]==hostOf(DEAD_ADDRESS)][0][3]
+        sim_devices[int(DEAD_ADDRESS[-1])].online = False
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    def client(seed):
+        rng = random.Random(seed)
+        socket = zmq.Context.instance().socket(zmq.REQ)
+        socket.connect(f'tcp://localhost:{port}')
+        mine = []
+        for k in range(requests):
+            addr = addrs[(seed+k) % len(addrs)]
+            if rng.random() < writeFraction:
+                message = f'{addr}:::SetVoltage:::{rng.choice([1.1,1.2])}'
+            else:
+                message = f'{addr}:::ReadPower'
+            t = time.perf_counter()
+            socket.send_string(message)
+            reply = socket.recv_string()
+            if deadDevice and addr==DEAD_ADDRESS:
+                continue
+            mine.append(time.perf_counter()-t)
+            if reply.startswith('ERROR') or reply[1:-1]=='-1, -1, -1':
+                with lock:
+                    errors[0] += 1
+        socket.close()
+        with lock:
+            latencies.extend(mine)
+    before = transactions(sim)
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = summarize(latencies, time.perf_counter()-start, transactions(sim)-before, errors[0])
+    if deadDevice:
+        sim_devices[int(DEAD_ADDRESS[-1])].online = True
+    return result
+
+
+def benchPipelined(sim, port, requests, depth):
+    """One gpib_client connection keeping depth ReadPower requests in flight over every supply"""
+    from gpib_client import GPIBClient, ServerError
+    before = transactions(sim)
+    latencies = []
+    errors = 0
+    with GPIBClient(f'tcp://localhost:{port}') as client:
+        start = time.perf_counter()
+        inFlight = []
+        for k in range(requests+depth):
+            if len(inFlight) == depth or k >= requests:
+                t, future = inFlight.pop(0)
+                try:
+                    future.result()
+                except ServerError:
+                    errors += 1
+                latencies.append(time.perf_counter()-t)
+            if k < requests:
+                inFlight.append((time.perf_counter(), client.command(ADDRESSES[k % len(ADDRESSES)], 'ReadPower')))
+        elapsed = time.perf_counter()-start
+    return summarize(latencies, elapsed, transactions(sim)-before, errors)
+
+
+def runAll(args):
+    results = {}
+    with makeSimulator(args.latency, args.jitter) as sim:
+        results['driver_readpower'] = benchDriver(sim, args.requests)
+        print_result('driver_readpower', results['driver_readpower'])
+        results['driver_readpower_auto'] = benchDriver(sim, args.requests, auto=True)
+        print_result('driver_readpower_auto', results['driver_readpower_auto'])
+        if args.driver_only:
+            return results
+        server = ServerProcess(args.port)
+        try:
+            server.waitReady()
+            scenarios = [('server_1x1', dict(clients=1, supplies=1)),
+                         ('server_1x5', dict(clients=1, supplies=5)),
+                         (f'server_{args.clients}x5', dict(clients=args.clients, supplies=5)),
+                         (f'server_{args.clients}x5_mixed', dict(clients=args.clients, supplies=5, writeFraction=0.2)),
+                         (f'server_{args.clients}x5_dead', dict(clients=args.clients, supplies=5, deadDevice=True))]
+            results['server_pipelined_16'] = benchPipelined(sim, args.port, args.requests, 16)
+            print_result('server_pipelined_16', results['server_pipelined_16'])
+            for name,kwargs in scenarios:
+                results[name] = benchServer(sim, args.port, requests=args.requests//kwargs['clients'], **kwargs)
+                print_result(name, results[name])
+        finally:
+            server.stop()
+    return results
+
+def print_result(name, r):
+    print(f"{name:28s} {r['requests']:6d} req  {r['throughput']:8.1f}/s  p50 {r['p50_ms']:7.2f} ms"
+          f"  p95 {r['p95_ms']:7.2f} ms  p99 {r['p99_ms']:7.2f} ms  {r['bus_per_request']:5.2f} bus/req  {r['errors']} errors")
+
+def compare(results, baseline):
+    print(f"\n{'scenario':28s} {'throughput':>12s} {'p99':>12s} {'bus/req':>12s}   (current/baseline)")
+    for name,r in results.items():
+        if name not in baseline:
+            continue
+        b = baseline[name]
+        ratio = lambda key: r[key]/b[key] if b[key] else float('nan')
+        print(f"{name:28s} {ratio('throughput'):12.2f} {ratio('p99_ms'):12.2f} {ratio('bus_per_request'):12.2f}")
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', default=500, type=int, help='Requests per scenario')
+    parser.add_argument('--clients', default=4, type=int, help='Concurrent clients in the multi-client scenarios')
+    parser.add_argument('--latency', default=0.002, type=float, help='Simulated instrument latency per transaction (s)')
+    parser.add_argument('--jitter', default=0.001, type=float, help='Simulated latency jitter (s)')
+    parser.add_argument('--port', default=15560, type=int, help='Port for the gpib_server under test')
+    parser.add_argument('--driver-only', default=False, action='store_true', help='Skip the gpib_server scenarios')
+    parser.add_argument('--output', default=None, help='Save results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare against')
+    parser.add_argument('--label', default=None, help='Name stored with the results, e.g. a git revision')
+    args = parser.parse_args()
+
+    results = runAll(args)
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump({'label': args.label, 'time': time.time(), 'settings': vars(args), 'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
@@ -0,0 +1,199 @@
+import json
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import PowerSupplyControls
+from PowerSupplyControls import getPowerSupply, gpibSession, gpibControl, SiglentSPD1168X
+
+logger = logging.getLogger("discovery")
+
+
+def _probeController(host, addrs):
+    #a Prologix box only takes one client at a time, so addresses behind it are probed
+    #in turn over one connection that the drivers found on it then share
+    found = {addr: None for addr in addrs}
+    try:
+        gpib = gpibSession(host)
+    except OSError:
+        return None, found
+    for addr in addrs:
+        try:
+            found[addr] = getPowerSupply(host, addr[-1], gpib)
+        except Exception:
+            pass
+    return gpib, found
+
+def _probeSiglent(ip):
+    if not ip:
+        return None
+    try:
+        ps = SiglentSPD1168X(ip)
+    except Exception:
+        return None
+    try:
+        #checks something answers there, and fills the driver's response cache
+        ps.ID()
+    except Exception:
+        ps.close()
+        return None
+    return ps
+
+def findSupply(addr, controllers, siglentIP, openSession):
+    """
+    Look again for one supply, on the controllers in order and then as a Siglent.
+    openSession(host) is a context manager giving the open connection to a controller that is
+    already in use, or None to have the driver open its own.
+    Returns (ps, host, gpibAddr), or None if it is still not there.
+    """
+    for host in controllers:
+        try:
+            with openSession(host) as gpib:
+                return getPowerSupply(host, addr[-1], gpib), host, addr[-1]
+        except Exception:
+            pass
+    ps = _probeSiglent(siglentIP.format(addr=addr))
+    if ps is None:
+        return None
+    return ps, siglentIP.format(addr=addr), None
+
+def discover(addrs, controllers, siglentIP):
+    """
+    Probe every candidate location of every address in parallel.
+
+    Each address is looked for on the gpib controllers in the order given, then as a
+    Siglent supply at siglentIP.format(addr=addr).  Returns {addr: (ps, host, gpibAddr)},
+    with ps None for addresses that were not found.
+    """
+    with ThreadPoolExecutor(max_workers=len(controllers)+len(addrs)) as executor:
+        gpibProbes = {host: executor.submit(_probeController, host, addrs) for host in controllers}
+        siglentProbes = {addr: executor.submit(_probeSiglent, siglentIP.format(addr=addr)) for addr in addrs}
+        gpibSessions = {host: f.result()[0] for host,f in gpibProbes.items()}
+        gpibFound = {host: f.result()[1] for host,f in gpibProbes.items()}
+        siglentFound = {addr: f.result() for addr,f in siglentProbes.items()}
+
+    found = {}
+    for addr in addrs:
+        found[addr] = (None, None, None)
+        for host in controllers:
+            if gpibFound[host][addr] is not None:
+                found[addr] = (gpibFound[host][addr], host, addr[-1])
+                break
+        else:
+            if siglentFound[addr] is not None:
+                found[addr] = (siglentFound[addr], siglentIP.format(addr=addr), None)
+        #close a Siglent connection if the address was also found on gpib
+        if siglentFound[addr] is not None and siglentFound[addr] is not found[addr][0]:
+            siglentFound[addr].close()
+        if found[addr][0] is None:
+            logger.error(f'Power supply with address {addr} not found')
+        else:
+            logger.info(f'Found power supply {addr} ({type(found[addr][0]).__name__}) at {found[addr][1]} gpib address {found[addr][2]}')
+    usedHosts = set(host for ps,host,gpibAddr in found.values())
+    for host,gpib in gpibSessions.items():
+        if gpib is not None and host not in usedHosts:
+            gpib.close()
+    return found
+
+
+def loadInventory(fileName):
+    if not os.path.exists(fileName):
+        return {}
+    try:
+        with open(fileName) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f'Could not read inventory {fileName}: {e}')
+        return {}
+
+def saveInventory(fileName, found):
+    inventory = {addr: {'host': host, 'gpib': gpibAddr, 'model': type(ps).__name__}
+                 for addr,(ps,host,gpibAddr) in found.items() if ps is not None}
+    tmpName = fileName+'.tmp'
+    with open(tmpName,'w') as f:
+        json.dump(inventory, f, indent=2)
+    os.replace(tmpName, fileName)
+
+
+def _openEntry(entry, gpib=None):
+    #constructing the driver queries *IDN? once (and checks it for the gpib models)
+    driver = getattr(PowerSupplyControls, entry['model'])
+    if entry['gpib'] is None:
+        ps = driver(entry['host'])
+        ps.ID()
+    else:
+        ps = driver(entry['host'], entry['gpib'], gpib)
+    return ps
+
+def _validateController(entries):
+    found = {}
+    gpib = None
+    for addr,entry in entries:
+        try:
+            if entry['gpib'] is not None and gpib is None:
+                gpib = gpibSession(entry['host'])
+            found[addr] = (_openEntry(entry, gpib), entry['host'], entry['gpib'])
+        except Exception as e:
+            logger.info(f'Inventory entry for {addr} no longer valid: {e}')
+    if gpib is not None and not found:
+        gpib.close()
+    return found
+
+def validateInventory(inventory):
+    """
+    Check each cached device with a single *IDN?, in parallel across controllers.
+    Returns {addr: (ps, host, gpibAddr)} for the entries that still answer.
+    """
+    byHost = {}
+    for addr,entry in inventory.items():
+        byHost.setdefault(entry['host'], []).append((addr, entry))
+    found = {}
+    if not byHost:
+        return found
+    with ThreadPoolExecutor(max_workers=len(byHost)) as executor:
+        for result in executor.map(_validateController, byHost.values()):
+            found.update(result)
+    return found
+
+
+def _release(drivers):
+    #drivers on one controller share its connection: return each address to local mode,
+    #then close the connection once
+    sessions = {}
+    for ps in drivers:
+        if isinstance(ps, gpibControl):
+            sessions.setdefault(id(ps.gpib), (ps.gpib, []))[1].append(ps.addr)
+        else:
+            sessions[id(ps)] = (ps, None)
+    for conn,addrs in sessions.values():
+        try:
+            if addrs is None:
+                conn.disconnect()
+            else:
+                conn.disconnect(addrs)
+        except OSError:
+            pass
+        conn.close()
+
+def findPowerSupplies(addrs, controllers, siglentIP, inventoryFile=None, rescan=False):
+    """
+    Locate the supplies, trusting a validated inventory file when one exists and only
+    rescanning for the addresses it does not cover.
+    The drivers are returned set back to local mode with their connections closed.
+    """
+    found = {}
+    if inventoryFile and not rescan:
+        #only entries at locations this process is allowed to look at
+        inventory = {addr: entry for addr,entry in loadInventory(inventoryFile).items()
+                     if addr in addrs and (entry['host'] in controllers or (siglentIP and entry['host']==siglentIP.format(addr=addr)))}
+        found = validateInventory(inventory)
+        for addr in found:
+            logger.info(f'Using inventory entry for power supply {addr} at {found[addr][1]}')
+    missing = [addr for addr in addrs if addr not in found]
+    if missing:
+        #a Prologix box takes one client at a time, so let go of the validated sessions first
+        _release([ps for ps,host,gpibAddr in found.values()])
+        found.update(discover(missing, controllers, siglentIP))
+    if inventoryFile:
+        saveInventory(inventoryFile, found)
+    _release([ps for ps,host,gpibAddr in found.values() if ps is not None])
+    return {addr: found[addr] for addr in addrs}
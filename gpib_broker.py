@@ -0,0 +1,451 @@
+#!/usr/bin/python3
+"""
+Front end for several gpib_server worker processes.
+
+Clients talk to the broker exactly as they would to gpib_server (REQ or DEALER, ':::' strings
+or gpib/json).  Workers are gpib_server processes started with --broker, each owning some
+controllers; they connect a DEALER to the backend port and send a heartbeat every second
+listing the supplies and controllers they serve.  The broker routes each request to the
+worker owning its address, splits ReadAll, STATS, groups and gpib/json batches across
+workers and merges the replies.
+
+A worker missing HEARTBEAT_LIVENESS heartbeats is dropped.  Requests it had been sent are
+answered with DEVICE_ERROR rather than sent again, since it may already have run them;
+requests for its addresses that arrive afterwards wait up to --reroute-timeout seconds for
+another worker (or its restart) to register the address.
+With --spawn the broker runs one worker per controller itself and restarts any that exit.
+
+    python gpib_broker.py --spawn 192.168.1.50 192.168.1.51 --siglent-ip 192.168.1.1{addr}
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import threading
+import subprocess
+import zmq
+import zmq.asyncio
+
+HEARTBEAT = b'HEARTBEAT'
+DISCONNECT = b'DISCONNECT'
+HEARTBEAT_INTERVAL = 1.
+HEARTBEAT_LIVENESS = 3
+
+# kept in step with gpib_server
+JSON_PROTOCOL = b'gpib/json'
+UNKNOWN_ADDRESS, BAD_ARGUMENT, DEVICE_ERROR = 1, 3, 4
+
+logger = logging.getLogger("gpib_broker")
+
+
+class Worker:
+    def __init__(self, identity):
+        self.identity = identity
+        self.addresses = set()
+        self.controllers = set()
+        self.lastHeard = time.monotonic()
+        self.jobs = set()
+
+    def alive(self):
+        return time.monotonic()-self.lastHeard < HEARTBEAT_LIVENESS*HEARTBEAT_INTERVAL
+
+
+class Job:
+    """One part of a client request, sent to a single worker"""
+    def __init__(self, request, index, key, body):
+        self.request = request
+        self.index = index
+        # ('addr', addr), ('host', host) or ('worker', identity)
+        self.key = key
+        self.body = body
+        self.worker = None
+        self.tag = None
+        self.queued = time.monotonic()
+
+
+class Request:
+    """A client request: its envelope, its parts and how to merge their replies into one"""
+    def __init__(self, envelope, combine):
+        self.envelope = envelope
+        self.combine = combine
+        self.replies = []
+        self.remaining = 0
+
+
+class Broker:
+    def __init__(self, frontend, backend, reroute_timeout=10., groups=None):
+        self.frontend = frontend
+        self.backend = backend
+        self.rerouteTimeout = reroute_timeout
+        self.groups = groups or {}
+        self.workers = {}
+        self.known = set()
+        self.jobs = {}
+        self.waiting = []
+        self.nextTag = 0
+        self.started = time.monotonic()
+
+    def owner(self, key):
+        kind, name = key
+        for worker in self.workers.values():
+            if (kind=='addr' and name in worker.addresses) or (kind=='host' and name in worker.controllers) \
+               or (kind=='worker' and name==worker.identity):
+                return worker
+        return None
+
+    # requests from clients
+
+    async def onClient(self, frames):
+        #a malformed request gets an error reply, it must not stop the broker
+        envelope, body = frames[:1], []
+        try:
+            i = frames.index(b'')
+            envelope, body = frames[:i+1], frames[i+1:]
+            request, parts = self.plan(envelope, body)
+        except (IndexError, ValueError, AttributeError, TypeError, KeyError, UnicodeDecodeError) as e:
+            await self.frontend.send_multipart(envelope + self.errorReply(body, BAD_ARGUMENT, f'Bad request: {e}'))
+            return
+        except Exception as e:
+            logger.error(f'Could not plan request: {e}')
+            await self.frontend.send_multipart(envelope + self.errorReply(body, DEVICE_ERROR, str(e)))
+            return
+        request.replies = [None]*len(parts)
+        request.remaining = len(parts)
+        if not parts:
+            await self.reply(request)
+            return
+        for n,(key,partBody) in enumerate(parts):
+            await self.dispatch(Job(request, n, key, partBody))
+
+    def errorReply(self, body, status, error):
+        if body[:1]==[JSON_PROTOCOL]:
+            return [JSON_PROTOCOL, json.dumps({'id': None, 'results': [], 'status': status, 'error': error}).encode()]
+        return [f'ERROR {error}'.encode()]
+
+    def plan(self, envelope, body):
+        """Split a client request into (key, body) parts and say how to merge the replies"""
+        if body[0]==JSON_PROTOCOL:
+            return self.planBatch(envelope, json.loads(body[1]),
+                                  lambda response: [JSON_PROTOCOL, json.dumps(response).encode()])
+        message = body[0].decode()
+        fields = message.split(':::')
+        target = fields[0]
+        if target=='STATS':
+            return self.planBroadcast(envelope, body, self.mergeStats(fields[1:2]==['prometheus']))
+        if fields[1:2]==['ReadAll']:
+            if target=='*':
+                return self.planBroadcast(envelope, body, self.mergeReadAll)
+            return Request(envelope, lambda replies: replies[0] or [f'Unknown Controller {target}'.encode()]), [(('host', target), body)]
+        if target.startswith('@'):
+            if target[1:] not in self.groupNames():
+                return Request(envelope, lambda replies: [f'Unknown Group {target[1:]}'.encode()]), []
+            batch = {'commands': [{'group': target[1:], 'cmd': fields[1], 'args': fields[2:]}]}
+            return self.planBatch(envelope, batch,
+                                  lambda response: [json.dumps({r['addr']: r for r in response['results']}).encode()])
+        if not self.mayExist(target):
+            return Request(envelope, lambda replies: [f'Unknown Address {target}'.encode()]), []
+        return Request(envelope, lambda replies: replies[0] or [f'ERROR no worker for {target}'.encode()]), [(('addr', target), body)]
+
+    def planBroadcast(self, envelope, body, merge):
+        identities = [w.identity for w in self.workers.values() if w.alive()]
+        request = Request(envelope, lambda replies: merge(dict(zip(identities, replies))))
+        return request, [(('worker', identity), body) for identity in identities]
+
+    def groupNames(self):
+        return set(self.groups) | {'all'}
+
+    def mayExist(self, addr):
+        #before the workers have had time to register, any address may turn up
+        return addr in self.known or time.monotonic()-self.started < self.rerouteTimeout
+
+    def planBatch(self, envelope, batch, encode):
+        """gpib/json commands, groups expanded, sent on in one batch per address"""
+        if not isinstance(batch.get('commands', []), list):
+            raise ValueError('commands must be a list')
+        commands = []
+        for c in batch.get('commands', []):
+            if not isinstance(c, dict):
+                raise ValueError(f'Every command must be an object, not {json.dumps(c)}')
+            if 'group' in c:
+                if not isinstance(c['group'], str):
+                    raise ValueError(f'group must be a name, not {json.dumps(c["group"])}')
+                members = sorted(self.known) if c['group']=='all' else self.groups.get(c['group'], [])
+                commands += [{k: v for k,v in c.items() if k!='group'} | {'addr': str(addr)} for addr in members]
+            else:
+                commands.append(c)
+        byAddr = {}
+        immediate = {}
+        for n,c in enumerate(commands):
+            addr = str(c.get('addr'))
+            if self.mayExist(addr):
+                byAddr.setdefault(addr, []).append(n)
+            else:
+                immediate[n] = {'addr': addr, 'cmd': c.get('cmd'), 'status': UNKNOWN_ADDRESS,
+                                'error': f'Unknown Address {addr}', 'time': time.time()}
+        addrs = list(byAddr)
+        def combine(replies):
+            results = dict(immediate)
+            for addr,reply in zip(addrs, replies):
+                partial = json.loads(reply[1])['results'] if reply is not None else []
+                for k,n in enumerate(byAddr[addr]):
+                    if k < len(partial):
+                        results[n] = partial[k]
+                    else:
+                        results[n] = {'addr': addr, 'cmd': commands[n].get('cmd'), 'status': DEVICE_ERROR,
+                                      'error': f'No worker for {addr}', 'time': time.time()}
+            return encode({'id': batch.get('id'), 'results': [results[n] for n in range(len(commands))]})
+        parts = [(('addr', addr), [JSON_PROTOCOL, json.dumps({'id': batch.get('id'),
+                                                              'commands': [commands[n] for n in byAddr[addr]]}).encode()])
+                 for addr in addrs]
+        return Request(envelope, combine), parts
+
+    def mergeStats(self, prometheus):
+        def merge(replies):
+            if prometheus:
+                return [mergePrometheus({identity: reply[0] for identity,reply in replies.items() if reply is not None}).encode()]
+            return [json.dumps({identity.decode(errors='replace'): json.loads(reply[0]) for identity,reply in replies.items()
+                                if reply is not None}).encode()]
+        return merge
+
+    def mergeReadAll(self, replies):
+        output = {}
+        for reply in replies.values():
+            if reply is None:
+                continue
+            for addr,result in json.loads(reply[0]).items():
+                #every worker lists the supplies it did not find, keep the reading of the one that did
+                if addr not in output or 'host' in result:
+                    output[addr] = result
+        return [json.dumps(output).encode()]
+
+    # sending work out and collecting it back
+
+    async def dispatch(self, job):
+        worker = self.owner(job.key)
+        if worker is None or not worker.alive():
+            if job.key[0]=='worker':
+                await self.complete(job, None)
+            else:
+                self.waiting.append(job)
+            return
+        self.nextTag += 1
+        job.tag = b'%d' % self.nextTag
+        job.worker = worker
+        worker.jobs.add(job.tag)
+        self.jobs[job.tag] = job
+        await self.backend.send_multipart([worker.identity, b'', job.tag, b''] + job.body)
+
+    async def complete(self, job, reply):
+        request = job.request
+        request.replies[job.index] = reply
+        request.remaining -= 1
+        if request.remaining == 0:
+            await self.reply(request)
+
+    async def reply(self, request):
+        try:
+            body = request.combine(request.replies)
+        except Exception as e:
+            logger.error(f'Could not merge replies: {e}')
+            body = [f'ERROR {e}'.encode()]
+        await self.frontend.send_multipart(request.envelope + body)
+
+    async def onWorker(self, frames):
+        identity = frames[0]
+        worker = self.workers.get(identity)
+        if frames[2:3]==[DISCONNECT]:
+            if worker is not None:
+                await self.remove(worker, 'disconnected')
+            return
+        if worker is None:
+            worker = self.workers[identity] = Worker(identity)
+            logger.info(f'Worker {identity.decode(errors="replace")} registered')
+        worker.lastHeard = time.monotonic()
+        if frames[2:3]==[HEARTBEAT]:
+            info = json.loads(frames[3])
+            worker.addresses = set(info['addresses'])
+            worker.controllers = set(info['controllers'])
+            self.known |= worker.addresses
+            await self.retryWaiting()
+            return
+        tag, body = frames[2], frames[4:]
+        job = self.jobs.pop(tag, None)
+        if job is None:
+            return
+        worker.jobs.discard(tag)
+        await self.complete(job, body)
+
+    async def remove(self, worker, reason):
+        logger.error(f'Worker {worker.identity.decode(errors="replace")} {reason}, failing {len(worker.jobs)} requests sent to it')
+        del self.workers[worker.identity]
+        for tag in worker.jobs:
+            job = self.jobs.pop(tag)
+            job.worker = None
+            #the worker may have run it already, sending it again could set a supply or run a sequence twice
+            await self.complete(job, None if job.key[0]=='worker' else self.lostReply(job, reason))
+        await self.retryWaiting()
+
+    def lostReply(self, job, reason):
+        """Reply for a job whose worker went away after it was sent"""
+        error = f'Worker {reason} before replying, the command may have run'
+        if job.body[0]==JSON_PROTOCOL:
+            batch = json.loads(job.body[1])
+            results = [{'addr': c.get('addr'), 'cmd': c.get('cmd'), 'status': DEVICE_ERROR, 'error': error, 'time': time.time()}
+                       for c in batch['commands']]
+            return [JSON_PROTOCOL, json.dumps({'id': batch.get('id'), 'results': results}).encode()]
+        return [f'ERROR {error}'.encode()]
+
+    async def retryWaiting(self):
+        waiting, self.waiting = self.waiting, []
+        now = time.monotonic()
+        for job in waiting:
+            if self.owner(job.key) is not None:
+                await self.dispatch(job)
+            elif now-job.queued > self.rerouteTimeout:
+                await self.complete(job, None)
+            else:
+                self.waiting.append(job)
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            for worker in list(self.workers.values()):
+                if not worker.alive():
+                    await self.remove(worker, 'stopped sending heartbeats')
+                else:
+                    await self.backend.send_multipart([worker.identity, b'', HEARTBEAT])
+            await self.retryWaiting()
+
+    async def run(self):
+        poller = zmq.asyncio.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        beats = asyncio.create_task(self.heartbeat())
+        try:
+            while True:
+                for socket,event in await poller.poll():
+                    frames = await socket.recv_multipart()
+                    if socket is self.frontend:
+                        await self.onClient(frames)
+                    else:
+                        await self.onWorker(frames)
+        finally:
+            beats.cancel()
+
+
+def mergePrometheus(texts):
+    """
+    Prometheus text from several workers ({identity: text}) as one exposition: the HELP and TYPE
+    of each metric once, followed by all its samples, each labelled with the worker it came from
+    """
+    families = {}
+    for identity,text in texts.items():
+        worker = identity.decode(errors='replace').replace('\\', '\\\\').replace('"', '\\"')
+        family = families.setdefault('', {'meta': {}, 'samples': []})
+        for line in text.decode(errors='replace').splitlines():
+            if line.startswith('#'):
+                fields = line.split(' ', 3)
+                if len(fields) >= 3 and fields[1] in ('HELP', 'TYPE'):
+                    family = families.setdefault(fields[2], {'meta': {}, 'samples': []})
+                    family['meta'].setdefault(fields[1], line)
+                continue
+            if not line.strip():
+                continue
+            name, brace, rest = line.partition('{')
+            if brace:
+                family['samples'].append(f'{name}{{worker="{worker}"{"," if not rest.startswith("}") else ""}{rest}')
+            else:
+                name, _, value = line.partition(' ')
+                family['samples'].append(f'{name}{{worker="{worker}"}} {value}')
+    lines = []
+    for family in families.values():
+        lines += [family['meta'][kind] for kind in ('HELP', 'TYPE') if kind in family['meta']] + family['samples']
+    return '\n'.join(lines)+'\n'
+
+def workerCommands(args, workerArgs):
+    """gpib_server command lines for one worker per controller, and one for the Siglent supplies"""
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gpib_server.py')
+    common = [sys.executable, server, '--broker', f'tcp://localhost:{args.backend}', '--addresses', *args.addresses]
+    if args.pub_port:
+        common += ['--pub-port', f'tcp://localhost:{args.pub_backend}']
+    else:
+        common += ['--pub-port', '']
+    commands = {host: common + ['--controllers', host, '--siglent-ip', '', '--inventory', f'inventory_{host}.json', *workerArgs]
+                for host in args.spawn}
+    if args.siglent_ip:
+        commands['siglent'] = common + ['--controllers', '--siglent-ip', args.siglent_ip, '--inventory', 'inventory_siglent.json', *workerArgs]
+    return commands
+
+async def supervise(commands):
+    """Run the worker processes, starting again any that exit"""
+    processes = {}
+    try:
+        while True:
+            for name,command in commands.items():
+                if name not in processes or processes[name].poll() is not None:
+                    if name in processes:
+                        logger.error(f'Worker for {name} exited with {processes[name].returncode}, restarting')
+                    processes[name] = subprocess.Popen(command)
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+
+def forwardReadings(subscribeBackend, publishPort):
+    #workers publish readings to the broker, which republishes them to subscribers
+    context = zmq.Context.instance()
+    xsub = context.socket(zmq.XSUB)
+    xsub.bind(f'tcp://*:{subscribeBackend}')
+    xpub = context.socket(zmq.XPUB)
+    xpub.bind(f'tcp://*:{publishPort}')
+    thread = threading.Thread(target=zmq.proxy, args=(xsub, xpub), daemon=True)
+    thread.start()
+
+async def main(args, workerArgs):
+    context = zmq.asyncio.Context.instance()
+    frontend = context.socket(zmq.ROUTER)
+    frontend.bind(f'tcp://*:{args.port}')
+    backend = context.socket(zmq.ROUTER)
+    backend.bind(f'tcp://*:{args.backend}')
+    groups = {}
+    if args.groups:
+        with open(args.groups) as f:
+            groups = {name: [str(addr) for addr in members] for name,members in json.load(f).items()}
+    broker = Broker(frontend, backend, args.reroute_timeout, groups)
+    tasks = [asyncio.create_task(broker.run())]
+    if args.spawn is not None:
+        tasks.append(asyncio.create_task(supervise(workerCommands(args, workerArgs))))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        frontend.close()
+        backend.close()
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(epilog='Arguments not listed here are passed on to spawned workers')
+    parser.add_argument('--port', default='5560', help='Port clients send requests to')
+    parser.add_argument('--backend', default='5570', help='Port workers connect to')
+    parser.add_argument('--pub-port', default='5561', help='Port the readings published by workers are republished on (empty to disable)')
+    parser.add_argument('--pub-backend', default='5571', help='Port workers publish their readings to')
+    parser.add_argument('--reroute-timeout', default=10., type=float, help='Seconds a request waits for a worker serving its address')
+    parser.add_argument('--groups', default=None, help='JSON file of named groups of supply addresses, as for gpib_server')
+    parser.add_argument('--spawn', default=None, nargs='*', help='Run a local worker for each of these controllers')
+    parser.add_argument('--siglent-ip', default='', help='With --spawn, also run a worker for Siglent supplies at this address pattern')
+    parser.add_argument('--addresses', default=['42','43','44','46','48'], nargs='+', help='Power supply addresses spawned workers look for')
+    args, workerArgs = parser.parse_known_args()
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)-2s: %(name)-15s %(message)s")
+    if args.pub_port:
+        forwardReadings(args.pub_backend, args.pub_port)
+    try:
+        asyncio.run(main(args, workerArgs))
+    except KeyboardInterrupt:
+        logger.info('Stopping broker after keyboard interrupt')
@@ -0,0 +1,207 @@
+"""
+Client for gpib_server (or gpib_broker).
+
+One DEALER socket carries every request, each tagged with an id that the server echoes back,
+so any number of requests can be in flight at once and replies are matched up however they
+arrive.  Requests use the gpib/json protocol, so results come back as numbers and status codes.
+
+    client = GPIBClient('tcp://localhost:5560')
+    ps = client.supply('46')
+    ps.SetLimits(1.2, 0.6)
+    ps.TurnOn()
+    p, v, i = ps.ReadPower()
+
+    # pipelined: send everything, then wait
+    futures = [client.command(addr, 'ReadPower') for addr in ('42', '43', '46')]
+    readings = [f.result() for f in futures]
+
+In asyncio code use AsyncGPIBClient directly, its methods are coroutines.
+"""
+import json
+import asyncio
+import threading
+import itertools
+import zmq
+import zmq.asyncio
+
+JSON_PROTOCOL = b'gpib/json'
+OK, UNKNOWN_ADDRESS, UNKNOWN_COMMAND, BAD_ARGUMENT, DEVICE_ERROR = 0, 1, 2, 3, 4
+
+class ServerError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def powerTuple(value):
+    return int(value['on']), float(value['voltage']), float(value['current'])
+
+
+class AsyncGPIBClient:
+    def __init__(self, endpoint='tcp://localhost:5560', timeout=10.):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.ids = itertools.count(1)
+        self.futures = {}
+        self.socket = None
+        self.receiver = None
+
+    def _connect(self):
+        if self.socket is None:
+            self.socket = zmq.asyncio.Context.instance().socket(zmq.DEALER)
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.connect(self.endpoint)
+            self.receiver = asyncio.ensure_future(self._receive())
+        return self.socket
+
+    async def _receive(self):
+        while True:
+            frames = await self.socket.recv_multipart()
+            #[id, b'', reply...], replies to requests that already timed out are dropped
+            future = self.futures.pop(frames[0], None)
+            if future is not None and not future.done():
+                future.set_result(frames[2:])
+
+    async def send(self, frames, timeout=None):
+        """Send one request (its body frames) and wait for the reply frames"""
+        socket = self._connect()
+        tag = b'%d' % next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.futures[tag] = future
+        try:
+            await socket.send_multipart([tag, b''] + frames)
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'No reply from {self.endpoint}')
+        finally:
+            self.futures.pop(tag, None)
+
+    async def message(self, message):
+        """A ':::' request, returning the reply string"""
+        return (await self.send([message.encode()]))[0].decode()
+
+    async def batch(self, commands):
+        """A gpib/json request of [{"addr", "cmd", "args", "maxAge"}, ...], returning its list of results"""
+        reply = await self.send([JSON_PROTOCOL, json.dumps({'commands': commands}).encode()])
+        response = json.loads(reply[1])
+        if 'error' in response:
+            raise ServerError(response.get('status', BAD_ARGUMENT), response['error'])
+        return response['results']
+
+    async def command(self, addr, cmd, *args, maxAge=None):
+        """One command, returning its value or raising ServerError"""
+        c = {'addr': str(addr), 'cmd': cmd, 'args': list(args)}
+        if maxAge is not None:
+            c['maxAge'] = maxAge
+        result = (await self.batch([c]))[0]
+        if result['status'] != OK:
+            raise ServerError(result['status'], result['error'])
+        return result.get('value')
+
+    async def ReadPower(self, addr, maxAge=None):
+        """(on, voltage, current), or (-1, -1, -1) if the supply could not be read, as the drivers return"""
+        try:
+            return powerTuple(await self.command(addr, 'ReadPower', maxAge=maxAge))
+        except ServerError as e:
+            if e.status != DEVICE_ERROR:
+                raise
+            return -1, -1, -1
+
+    async def SetLimits(self, addr, voltage, current=0.6):
+        """False if the voltage is outside the supply's safe range, as the drivers return"""
+        try:
+            await self.command(addr, 'SetVoltage', voltage, current)
+        except ServerError as e:
+            if e.status != BAD_ARGUMENT:
+                raise
+            return False
+
+    async def TurnOn(self, addr):
+        await self.command(addr, 'TurnOn')
+
+    async def TurnOff(self, addr):
+        await self.command(addr, 'TurnOff')
+
+    async def ID(self, addr):
+        return await self.command(addr, 'ID')
+
+    async def History(self, addr, n=100):
+        return await self.command(addr, 'History', n)
+
+    def close(self):
+        if self.receiver is not None:
+            self.receiver.cancel()
+        if self.socket is not None:
+            self.socket.close()
+        self.socket = None
+
+
+class GPIBClient:
+    """
+    Blocking client, running an AsyncGPIBClient on an event loop in a background thread.
+    command() and message() return concurrent.futures.Future without waiting, so requests
+    can be pipelined; the driver-style methods of supply() wait for their reply.
+    """
+    def __init__(self, endpoint='tcp://localhost:5560', timeout=10.):
+        self.client = AsyncGPIBClient(endpoint, timeout)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='gpib-client', daemon=True)
+        self.thread.start()
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def command(self, addr, cmd, *args, maxAge=None):
+        return self.submit(self.client.command(addr, cmd, *args, maxAge=maxAge))
+
+    def message(self, message):
+        return self.submit(self.client.message(message))
+
+    def batch(self, commands):
+        return self.submit(self.client.batch(commands))
+
+    def supply(self, addr):
+        return RemoteSupply(self, addr)
+
+    def close(self):
+        async def stop():
+            self.client.close()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.submit(stop()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RemoteSupply:
+    """One supply behind gpib_server, with the method names of the driver classes"""
+    def __init__(self, client, addr):
+        self.client = client
+        self.addr = str(addr)
+
+    def ReadPower(self, maxAge=None):
+        return self.client.submit(self.client.client.ReadPower(self.addr, maxAge)).result()
+
+    def SetLimits(self, voltage, current=0.6):
+        return self.client.submit(self.client.client.SetLimits(self.addr, voltage, current)).result()
+
+    def TurnOn(self):
+        self.client.submit(self.client.client.TurnOn(self.addr)).result()
+
+    def TurnOff(self):
+        self.client.submit(self.client.client.TurnOff(self.addr)).result()
+
+    def ID(self):
+        return self.client.submit(self.client.client.ID(self.addr)).result()
+
+    def History(self, n=100):
+        return self.client.submit(self.client.client.History(self.addr, n)).result()
@@ -1,40 +1,229 @@
 #!/usr/bin/python3
 
 import zmq
+import zmq.asyncio
+import asyncio
 import time
 import sys
 import random
-from PowerSupplyControls import getPowerSupply, SiglentSPD1168X
+import argparse
+import json
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from discovery import findPowerSupplies, findSupply
+from PowerSupplyControls import ReadPowerAll
+from instrument_pool import InstrumentPool
+from telemetry import RingBuffer, packSample
+from powerlog import PowerLogWriter
+from instrumentation import Stats
+from sequence import runSequence, parseSteps, SequenceError
+from health import DeviceHealth, applyTimeout
+from contextlib import contextmanager, nullcontext
+from gpib_broker import HEARTBEAT, DISCONNECT, HEARTBEAT_INTERVAL, HEARTBEAT_LIVENESS
+import os
+import socket as sockets
 import logging
+import logging.handlers
+import queue
+import threading
 
-logging.basicConfig(filename='server_log.log', level=logging.INFO, format="[%(asctime)s] %(levelname)-2s: %(name)-15s %(message)s")
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', default='5560', help='Port to listen for requests on')
+parser.add_argument('--idle-timeout', default=60., type=float, help='Seconds before an unused instrument connection is released')
+parser.add_argument('--health-interval', default=5., type=float, help='Seconds of idleness after which a connection is checked before reuse')
+parser.add_argument('--addresses', default=['42','43','44','46','48'], nargs='+', help='Power supply addresses to serve (last digit is the gpib address)')
+parser.add_argument('--controllers', default=['192.168.1.50','192.168.1.51'], nargs='*', help='IP addresses of the gpib controllers, in order of preference')
+parser.add_argument('--siglent-ip', default='192.168.1.1{addr}', help='IP address pattern of Siglent supplies (empty to not look for any)')
+parser.add_argument('--inventory', default='inventory.json', help='File caching where each power supply was found')
+parser.add_argument('--rescan', default=False, action='store_true', help='Ignore the inventory file and probe for every power supply')
+parser.add_argument('--groups', default=None, help='JSON file of named groups of supply addresses, e.g. {"standA": ["42","43"]}; group "all" is always defined')
+parser.add_argument('--poll-interval', default=0, type=float, help='Seconds between background reads of every supply (0 disables polling)')
+parser.add_argument('--pub-port', default='5561', help='Port readings are published on, topic is the supply address (empty to disable, or an endpoint such as tcp://localhost:5571 to publish through gpib_broker)')
+parser.add_argument('--power-log', default=None, help='Binary log file every reading is appended to (see powerlog.py)')
+parser.add_argument('--history', default=3600, type=int, help='Number of readings kept per supply')
+parser.add_argument('--breaker-failures', default=3, type=int, help='Consecutive failures after which requests to a supply fail fast until a background probe succeeds')
+parser.add_argument('--broker', default=None, help='Run as a worker of gpib_broker, connecting to its backend (e.g. tcp://localhost:5570) instead of listening on --port')
+parser.add_argument('--probe-interval', default=5., type=float, help='Seconds between background probes of supplies that are down or were not found')
+args = parser.parse_args()
+
+#log records are queued on the request path and written to the file by a listener thread
+logFile = logging.FileHandler('server_log.log')
+logFile.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)-2s: %(name)-15s %(message)s"))
+logQueue = queue.SimpleQueue()
+logListener = logging.handlers.QueueListener(logQueue, logFile)
+logListener.start()
+logQueueHandler = logging.handlers.QueueHandler(logQueue)
+logQueueHandler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[logQueueHandler])
 logger = logging.getLogger("gpib_server")
 
+stats = Stats()
+
 
 powerSupplies={}
-for addr in ['42','43','44','46','48']:
+found = findPowerSupplies(args.addresses, args.controllers, args.siglent_ip,
+                          inventoryFile=args.inventory, rescan=args.rescan)
+for addr,(ps,host,gpibAddr) in found.items():
+    powerSupplies[addr] = ps
+
+pool = InstrumentPool(idle_timeout=args.idle_timeout, health_interval=args.health_interval, timing=stats.observe)
+for addr,ps in powerSupplies.items():
+    if ps:
+        pool.add(addr,ps)
+for session in pool.sessions.values():
+    if hasattr(session.conn, 'timing'):
+        session.conn.timing = stats.observe
+pool.startReaper()
+
+groups = {'all': list(powerSupplies)}
+if args.groups:
+    with open(args.groups) as f:
+        groups.update({name: [str(addr) for addr in members] for name,members in json.load(f).items()})
+
+telemetry = {addr: RingBuffer(args.history) for addr in pool.addresses()}
+health = {addr: DeviceHealth(failures=args.breaker_failures, probe_interval=args.probe_interval) for addr in powerSupplies}
+publisher = None
+eventLoop = None
+powerLog = PowerLogWriter(args.power_log) if args.power_log else None
+
+def publish(addr, sample):
+    #the PUB socket belongs to the event loop thread, hand it readings taken elsewhere
+    if publisher is None:
+        return
+    frames = [addr.encode(), packSample(*sample)]
     try:
-        powerSupplies[addr] = getPowerSupply('192.168.1.50',addr[-1])
-        logger.info(f'Found power supply {addr} on gpib with ip 192.168.1.50')
-    except:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is eventLoop:
+        publisher.send_multipart(frames, zmq.NOBLOCK)
+    else:
+        eventLoop.call_soon_threadsafe(publisher.send_multipart, frames, zmq.NOBLOCK)
+
+def recordSample(addr, t, p, v, i):
+    if addr in telemetry:
+        telemetry[addr].append(t, p, v, i)
+        publish(addr, (t, p, v, i))
+        if powerLog is not None:
+            powerLog.write(int(addr), p, v, i, t)
+
+def recordSamples(results):
+    for addr,result in results.items():
+        if 'error' not in result:
+            recordSample(addr, result['time'], *result['power'])
+
+# status codes of the typed (gpib/json) protocol
+OK, UNKNOWN_ADDRESS, UNKNOWN_COMMAND, BAD_ARGUMENT, DEVICE_ERROR = 0, 1, 2, 3, 4
+
+class CommandError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+def powerUp(ps, args):
+    #only turn the output on if the voltage was accepted as within the safe range
+    if ps.SetLimits(float(args[0]),0.6) is False:
+        return False
+    ps.TurnOn()
+
+def setRemote(ps, args):
+    if args[0]=='4W':
+        ps.Set4Wire()
+    elif args[0]=='2W':
+        ps.Set2Wire()
+
+deviceCommands = {'ReadPower': lambda ps,args: ps.ReadPower(),
+                  'Ping': lambda ps,args: ps.ReadPower(),
+                  'SetVoltage': lambda ps,args: ps.SetLimits(float(args[0]),float(args[1]) if len(args)>1 else 0.6),
+                  'TurnOn': lambda ps,args: ps.TurnOn(),
+                  'TurnOff': lambda ps,args: ps.TurnOff(),
+                  'ID': lambda ps,args: ps.ID(),
+                  'SetRemote': setRemote,
+                  'PowerUp': powerUp,
+                  'Sequence': lambda ps,args: runSequence(ps, parseSteps(args[0])),
+                  }
+#commands run on sequenceExecutor rather than the controller's thread, queueing each of their
+#bus steps as a job of its own so that other supplies on the controller are served in between
+stepwiseCommands = ('Sequence',)
+
+legacyReplies = {'SetVoltage': 'Setting Voltage {addr} {arg}',
+                 'TurnOn': 'Turning On {addr}',
+                 'TurnOff': 'Turning Off {addr}',
+                 'SetRemote': 'Setting {addr} to {arg} mode',
+                 'PowerUp': 'Powering Up {addr} at {arg}',
+                 }
+
+def runCommand(addr, command, args):
+    """Run one of deviceCommands on the pooled session of a supply, returning what the driver returns"""
+    if addr not in powerSupplies:
+        raise CommandError(UNKNOWN_ADDRESS, f'Unknown Address {addr}')
+    if command not in deviceCommands:
+        raise CommandError(UNKNOWN_COMMAND, f'Unknown command {command}')
+    if powerSupplies[addr] is None:
+        raise CommandError(DEVICE_ERROR, f'Power supply {addr} not found')
+    if command=='ID':
+        #read once at discovery and kept by the driver, no need to open the session for it
+        cached = pool.devices[addr].responseCache().get('ID')
+        if cached is not None:
+            return cached
+    h = health[addr]
+    if not h.allow():
+        raise CommandError(DEVICE_ERROR, f'Power supply {addr} is not responding')
+    def guarded(ps):
+        applyTimeout(ps, h.timeout())
+        return deviceCommands[command](ps, args)
+    t = time.perf_counter()
+    try:
+        if command in stepwiseCommands:
+            #one at a time on a supply, and its steps not retried: a sequence that failed part way must not start over
+            with sequenceLocks.setdefault(addr, threading.Lock()):
+                output = runSequence(pool.devices[addr], parseSteps(args[0]), partial(queuedStep, addr, h))
+        else:
+            output = pool.call(addr, guarded)
+    except OSError:
+        h.record(time.perf_counter()-t, False)
+        raise
+    ok = command not in ('ReadPower','Ping') or list(output)!=[-1,-1,-1]
+    h.record(time.perf_counter()-t, ok, sample=command!='Sequence')
+    if command in ('ReadPower','Ping') and ok:
+        recordSample(addr, time.time(), *output)
+    return output
+
+def readGuarded(supplies):
+    """ReadPowerAll for the supplies that are up, skipping the others and feeding each result back to its health"""
+    results = {}
+    for addr,ps in supplies.items():
+        h = health[addr]
+        if not h.allow():
+            results[addr] = {'power': [-1,-1,-1], 'time': time.time(), 'error': 'not responding'}
+            continue
+        applyTimeout(ps, h.timeout())
+        t = time.perf_counter()
         try:
-            powerSupplies[addr] = getPowerSupply('192.168.1.51',addr[-1])
-            logger.info(f'Found power supply {addr} on gpib with ip 192.168.1.51')
-        except:
-            try:
-                powerSupplies[addr] = SiglentSPD1168X(f'192.168.1.1{addr}')
-                logger.info(f'Found power supply {addr} on gpib with ip 192.168.1.1{addr}')
-            except:
-                logger.error(f'Power supply with address {addr} not found on gpib')
-                powerSupplies[addr] = None
-    if powerSupplies[addr]:
-        powerSupplies[addr].disconnect()
-        powerSupplies[addr].close()
+            results.update(ReadPowerAll({addr: ps}))
+        except OSError:
+            h.record(time.perf_counter()-t, False)
+            raise
+        if results[addr].get('error')=='timed out':
+            #ReadPowerAll drained what had arrived, anything later is drained before the session's next use
+            pool.markStale(addr)
+        h.record(time.perf_counter()-t, 'error' not in results[addr] and results[addr]['power']!=[-1,-1,-1])
+    return results
 
 def gpib_call(input_message):
     """
     Function to parse gpib requests received over socket, to be sent to correct power supply
     Messages expected to be separated by three colons, with last digits of IP address coming first, and used for addressing the correct power supply
+    Instrument connections are held open in the pool between requests
+
+    Handled before reaching here:
+      "*:::ReadAll" reads every supply, "<controller ip>:::ReadAll" those behind one controller
+      "STATS" returns a JSON timing summary, "STATS:::prometheus" the same in Prometheus text
+      "addr:::ReadPower:::maxAge" and "addr:::Ping:::maxAge" are answered from the poller's readings when one is younger than maxAge seconds
+      "addr:::History:::N" returns the last N readings
+      "@group:::command:::arg" runs a command on every supply of a group, e.g. "@all:::PowerUp:::1.2"
+
+    "addr:::Sequence:::[steps]" runs a JSON sequence of steps (see sequence.py) and returns its log
     """
     message=input_message.split(':::')
     addr=message[0]
@@ -43,92 +232,523 @@ def gpib_call(input_message):
         logger.error(f"Trying to access unknown address {addr}")
         output = f'Unknown Address {message[0]}'
     else:
-        ps = powerSupplies[addr]
         if len(message)<2:
             print('No command specified')
             return ''
-        elif message[1]=='Ping':
+        command=message[1]
+        if command not in deviceCommands:
+            print(f'Bad Command {message}')
+            output='UNKOWN COMMAND'
+        elif command in ('ReadPower','Ping'):
             try:
-                ps.reconnect()
-                output=ps.ReadPower()
-                ps.disconnect()
-                ps.close()
+                output=runCommand(addr, command, message[2:])
             except:
                 output=[-1,-1,-1]
-            output=output[0]
-        elif message[1]=='ReadPower':
+            if command=='Ping':
+                output=output[0]
+        elif command=='Sequence':
             try:
-                ps.reconnect()
-                output=ps.ReadPower()
-                ps.disconnect()
-                ps.close()
-            except:
-                output=[-1,-1,-1]
-
-        elif message[1]=='SetVoltage':
-            ps.reconnect()
-            ps.SetLimits(float(message[2]),0.6)
-            ps.disconnect()
-            ps.close()
-            output=f'Setting Voltage {addr} {message[2]}'
-        elif message[1]=='TurnOn':
-            ps.reconnect()
-            ps.TurnOn()
-            ps.disconnect()
-            ps.close()
-            output=f'Turning On {addr}'
-        elif message[1]=='TurnOff':
-            ps.reconnect()
-            ps.TurnOff()
-            ps.disconnect()
-            ps.close()
-            output=f'Turning Off {addr}'
-        elif message[1]=='ID':
+                output=json.dumps(runCommand(addr, command, message[2:]))
+            except SequenceError as e:
+                output=f'Sequence failed: {e} {json.dumps(e.log)}'
+            except (ValueError, IndexError) as e:
+                output=f'Bad sequence: {e}'
+        elif command=='ID':
             try:
-                ps.reconnect()
-                output=ps.ID()
-                ps.disconnect()
-                ps.close()
+                output=runCommand(addr, command, message[2:])
             except:
                 output='UNKNOWN POWER SUPPLY'
-        elif message[1]=='SetRemote':
-            ps.reconnect()
-            if message[2]=='4W':
-                ps.Set4Wire()
-            elif message[2]=='2W':
-                ps.Set2Wire()
-            ps.disconnect()
-            ps.close()
-            output=f'Setting {addr} to {message[2]} mode'
         else:
-            print(f'Bad Command {message}')
-            output='UNKOWN COMMAND'
+            runCommand(addr, command, message[2:])
+            output=legacyReplies[command].format(addr=addr, arg=message[2] if len(message)>2 else '')
     logger.info(f"Returning: {output}")
     return output
 
-port = "5560"
-context = zmq.Context()
-socket = context.socket(zmq.REP)
-socket.bind("tcp://*:%s" % port)
+def typedValue(command, output):
+    if command=='ReadPower':
+        p,v,i = output
+        if [p,v,i]==[-1,-1,-1]:
+            raise CommandError(DEVICE_ERROR, 'Could not read power')
+        return {'on': int(p), 'voltage': float(v), 'current': float(i)}
+    if command=='Ping':
+        return int(output[0])
+    if command in ('SetVoltage','PowerUp') and output is False:
+        raise CommandError(BAD_ARGUMENT, 'Voltage outside of the safe range')
+    return output
+
+def commandTimer(addr, command):
+    #only supplies and commands that exist get a histogram, so requests cannot grow the stats without bound
+    if addr in powerSupplies and command in deviceCommands:
+        return stats.timer(addr, command)
+    return nullcontext()
+
+def typedResult(addr, command, args):
+    """Run one command of a gpib/json request, catching its errors into a status code"""
+    result = {'addr': addr, 'cmd': command}
+    try:
+        with commandTimer(addr, command):
+            result['value'] = typedValue(command, runCommand(addr, command, args))
+        result['status'] = OK
+    except CommandError as e:
+        result['status'] = e.status
+        result['error'] = str(e)
+    except SequenceError as e:
+        result['status'] = DEVICE_ERROR
+        result['error'] = str(e)
+        result['value'] = e.log
+    except (ValueError, IndexError) as e:
+        result['status'] = BAD_ARGUMENT
+        result['error'] = str(e)
+    except Exception as e:
+        result['status'] = DEVICE_ERROR
+        result['error'] = str(e)
+    result['time'] = time.time()
+    return result
+
+def runBatch(items):
+    return [(n, typedResult(addr, command, args)) for n,addr,command,args in items]
+
+async def runHostBatch(host, items):
+    """Run the items of one controller in order, the stepwise ones off its thread"""
+    loop = asyncio.get_running_loop()
+    done, run = [], []
+    for item in items + [None]:
+        if item is not None and item[2] not in stepwiseCommands:
+            run.append(item)
+            continue
+        if run:
+            done += await submitJob(host, partial(runBatch, run))
+            run = []
+        if item is not None:
+            done += await loop.run_in_executor(sequenceExecutor, runBatch, [item])
+    return done
+
+#one thread per controller host, also for hosts found after startup
+executors = {}
+commandQueues = {}
+controllerTasks = {}
+#sequences spend most of their time waiting, so each gets a thread of its own
+sequenceExecutor = ThreadPoolExecutor(max_workers=max(4, len(powerSupplies)), thread_name_prefix='sequence')
+sequenceLocks = {}
+
+async def controllerWorker(queue, executor):
+    """
+    Runs the jobs for one controller host in arrival order, so a GPIB bus only ever
+    sees one command at a time while other controllers are served in parallel
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        job, future = await queue.get()
+        try:
+            output = await loop.run_in_executor(executor, job)
+            if not future.cancelled():
+                future.set_result(output)
+        except Exception as e:
+            if not future.cancelled():
+                future.set_exception(e)
+        finally:
+            queue.task_done()
+
+async def awaitJob(host, job):
+    return await submitJob(host, job)
+
+def queuedStep(addr, h, func):
+    """From a sequence thread, run func(ps) as a job of its own on the controller of addr and wait for it"""
+    def step():
+        with pool.session(addr) as ps:
+            applyTimeout(ps, h.timeout())
+            return func(ps)
+    return asyncio.run_coroutine_threadsafe(awaitJob(pool.hostOf(addr), step), eventLoop).result()
+
+def submitJob(host, job):
+    """Queue job() to run on the thread serving host, returning a future for its result"""
+    future = asyncio.get_running_loop().create_future()
+    if host not in commandQueues:
+        commandQueues[host] = asyncio.Queue()
+        executors[host] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'gpib-{host}')
+        controllerTasks[host] = asyncio.create_task(controllerWorker(commandQueues[host], executors[host]))
+    commandQueues[host].put_nowait((job, future))
+    return future
+
+async def readAll(target):
+    """
+    Read power from every supply behind one controller host, or behind all of them for
+    target '*', holding each controller session once for all of its supplies
+    """
+    if target=='*':
+        hosts = list(pool.sessions)
+    elif target in pool.sessions:
+        hosts = [target]
+    else:
+        return f'Unknown Controller {target}'
+    results = await asyncio.gather(*[submitJob(host, partial(pool.callHost, host, readGuarded))
+                                     for host in hosts], return_exceptions=True)
+    output = {}
+    for host,result in zip(hosts, results):
+        if isinstance(result, Exception):
+            now = time.time()
+            result = {addr: {'power': [-1,-1,-1], 'time': now, 'error': str(result)} for addr in pool.addresses(host)}
+        for addr in result:
+            result[addr]['host'] = host
+        output.update(result)
+    recordSamples(output)
+    if target=='*':
+        for addr,ps in powerSupplies.items():
+            if ps is None:
+                output[addr] = {'power': [-1,-1,-1], 'time': time.time(), 'error': 'not found'}
+    return json.dumps(output)
+
+def fromTelemetry(message):
+    """Answer History, and ReadPower/Ping with a max age, from the ring buffers; None if the instrument is needed"""
+    fields = message.split(':::')
+    if len(fields)<3 or fields[0] not in telemetry:
+        return None
+    buffer = telemetry[fields[0]]
+    if fields[1]=='History':
+        return json.dumps(buffer.last(int(fields[2])))
+    if fields[1] in ('ReadPower','Ping'):
+        sample = buffer.latest()
+        if sample is not None and time.time()-sample[0] <= float(fields[2]):
+            output = tuple(sample[1:])
+            return output[0] if fields[1]=='Ping' else output
+    return None
+
+def typedFromTelemetry(addr, command, request):
+    """History, and ReadPower/Ping with a maxAge, answered from the ring buffers; None if the instrument is needed"""
+    if addr not in telemetry:
+        return None
+    if command=='History':
+        samples = telemetry[addr].last(int(request.get('args', [100])[0]))
+        return [{'time': t, 'on': p, 'voltage': v, 'current': i} for t,p,v,i in samples]
+    if command in ('ReadPower','Ping') and 'maxAge' in request:
+        sample = telemetry[addr].latest()
+        if sample is not None and time.time()-sample[0] <= float(request['maxAge']):
+            t,p,v,i = sample
+            return p if command=='Ping' else {'on': p, 'voltage': v, 'current': i}
+    return None
+
+async def handleBatch(request):
+    """
+    Run a gpib/json request, {"id": ..., "commands": [{"addr": "46", "cmd": "ReadPower", "args": [], "maxAge": 2}, ...]}
+    A command can name a "group" instead of an "addr" to be run on every supply in it
+    Commands on different controllers run concurrently, commands on one controller in the order given
+    Returns {"id": ..., "results": [{"addr", "cmd", "status", "value" or "error", "time"}, ...]} in request order
+    """
+    if not isinstance(request.get('commands', []), list):
+        raise ValueError('commands must be a list')
+    commands = []
+    for c in request.get('commands', []):
+        if not isinstance(c, dict):
+            raise ValueError(f'Every command must be an object, not {json.dumps(c)}')
+        if not isinstance(c.get('args', []), list):
+            raise ValueError(f'args must be a list, not {json.dumps(c["args"])}')
+        #{"group": "X", "cmd": ...} stands for the same command on every member of group X
+        if 'group' in c:
+            if not isinstance(c['group'], str):
+                raise ValueError(f'group must be a name, not {json.dumps(c["group"])}')
+            commands += [dict(c, addr=addr) for addr in groups.get(c['group'], [])]
+        else:
+            commands.append(c)
+    results = [None]*len(commands)
+    byHost = {}
+    for n,c in enumerate(commands):
+        addr, command = str(c.get('addr')), str(c.get('cmd'))
+        args = [arg if isinstance(arg, (list, dict)) else str(arg) for arg in c.get('args', [])]
+        try:
+            cached = typedFromTelemetry(addr, command, c)
+        except (ValueError, TypeError, IndexError) as e:
+            results[n] = {'addr': addr, 'cmd': command, 'status': BAD_ARGUMENT, 'error': str(e), 'time': time.time()}
+            continue
+        if cached is not None:
+            results[n] = {'addr': addr, 'cmd': command, 'status': OK, 'value': cached, 'time': time.time()}
+        elif command=='History':
+            results[n] = {'addr': addr, 'cmd': command, 'status': UNKNOWN_ADDRESS, 'error': f'Unknown Address {addr}', 'time': time.time()}
+        elif pool.hostOf(addr) is None:
+            results[n] = typedResult(addr, command, args)
+        else:
+            byHost.setdefault(pool.hostOf(addr), []).append((n, addr, command, args))
+    done = await asyncio.gather(*[runHostBatch(host, items) for host,items in byHost.items()])
+    for items in done:
+        for n,result in items:
+            results[n] = result
+    return {'id': request.get('id'), 'results': results}
+
+def timedCall(message, queued):
+    fields = message.split(':::')
+    stats.observe(fields[0], 'queue_wait', time.perf_counter()-queued)
+    with commandTimer(fields[0], fields[1] if len(fields)>1 else ''):
+        return gpib_call(message)
+
+def statsReport(fields):
+    if fields[1:2]==['prometheus']:
+        return stats.prometheus()
+    return json.dumps(stats.snapshot() | {'health': {addr: h.snapshot() for addr,h in health.items()}})
+
+async def groupCall(message):
+    """
+    Run "@group:::command:::args" on every member of the group, concurrently across controllers
+    and in turn within one, returning {addr: result} as JSON
+    """
+    fields = message.split(':::')
+    name = fields[0][1:]
+    logger.info(f"Received message: {message}")
+    if name not in groups:
+        return f'Unknown Group {name}'
+    if len(fields)<2:
+        return ''
+    response = await handleBatch({'commands': [{'group': name, 'cmd': fields[1], 'args': fields[2:]}]})
+    return json.dumps({result['addr']: result for result in response['results']})
+
+def submit(message):
+    addr = message.split(':::')[0]
+    if addr=='STATS':
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(statsReport(message.split(':::')))
+        return future
+    if addr.startswith('@'):
+        return asyncio.ensure_future(groupCall(message))
+    if message.split(':::')[1:2]==['ReadAll']:
+        logger.info(f"Received message: {message}")
+        return asyncio.ensure_future(readAll(addr))
+    future = asyncio.get_running_loop().create_future()
+    try:
+        cached = fromTelemetry(message)
+    except ValueError as e:
+        cached = f'Bad Argument {e}'
+    if cached is not None:
+        logger.info(f"Received message: {message}, answered from telemetry")
+        future.set_result(cached)
+        return future
+    host = pool.hostOf(addr)
+    if host is None:
+        #unknown or missing supply, answered without touching an instrument
+        try:
+            future.set_result(gpib_call(message))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    if len(message.split(':::'))>1 and message.split(':::')[1] in stepwiseCommands:
+        return asyncio.get_running_loop().run_in_executor(sequenceExecutor, timedCall, message, time.perf_counter())
+    return submitJob(host, partial(timedCall, message, time.perf_counter()))
+
+# typed requests are a two frame message, this tag then a JSON document; anything else is a ':::' string
+JSON_PROTOCOL = b'gpib/json'
+
+def splitEnvelope(frames):
+    #REQ (and DEALER) peers put their routing frames before an empty delimiter frame
+    i = frames.index(b'')
+    return frames[:i+1], frames[i+1:]
+
+async def handleRequest(socket, frames, prefix=[]):
+    #prefix goes before the reply envelope, the empty frame a DEALER worker owes the broker
+    envelope, body = splitEnvelope(frames)
+    envelope = prefix + envelope
+    if body[0]==JSON_PROTOCOL:
+        try:
+            request = json.loads(body[1])
+            logger.info(f"Received {len(request.get('commands', []))} typed commands")
+            response = await handleBatch(request)
+        except (IndexError, ValueError, AttributeError, TypeError, KeyError) as e:
+            response = {'id': None, 'results': [], 'status': BAD_ARGUMENT, 'error': f'Bad request: {e}'}
+        except Exception as e:
+            #a REQ client waits for a reply whatever went wrong
+            logger.error(f"Error handling typed request: {e}")
+            response = {'id': None, 'results': [], 'status': DEVICE_ERROR, 'error': str(e)}
+        await socket.send_multipart(envelope + [JSON_PROTOCOL, json.dumps(response).encode()])
+        return
+    message = body[0].decode()
+    try:
+        output = await submit(message)
+    except Exception as e:
+        logger.error(f"Error handling {message}: {e}")
+        output = f'ERROR {e}'
+    await socket.send_multipart(envelope + [f"{output}".encode()])
+
+# probes of a missing supply can block on connect timeouts, keep them off the controller threads
+probeExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='probe')
+
+def probe(addr):
+    """One read of a supply whose breaker is open, with the default timeout, closing the breaker if it answers"""
+    h = health[addr]
+    def read(ps):
+        applyTimeout(ps, h.defaultTimeout)
+        return ps.ReadPower()
+    t = time.perf_counter()
+    try:
+        ok = list(pool.call(addr, read))!=[-1,-1,-1]
+    except Exception:
+        ok = False
+    h.record(time.perf_counter()-t, ok, sample=False)
+    if ok:
+        logger.info(f"Power supply {addr} is responding again")
+
+@contextmanager
+def controllerSession(host, timeout=0.2):
+    #a controller the pool already holds is only lent for a short probe, others get their own session
+    if host in pool.sessions:
+        with pool.hostSession(host) as gpib:
+            previous = gpib.timeout
+            gpib.set_timeout(timeout)
+            try:
+                yield gpib
+            finally:
+                gpib.set_timeout(previous)
+    else:
+        yield None
+
+def rediscover(addr):
+    """
+    Look again for a supply that was not found, on the probe thread, and have the event loop
+    add it if it now answers; the loop owns the tables the other threads read
+    """
+    found = findSupply(addr, args.controllers, args.siglent_ip, controllerSession)
+    if found is not None:
+        eventLoop.call_soon_threadsafe(addSupply, addr, *found)
+
+def addSupply(addr, ps, host, gpibAddr):
+    pool.add(addr, ps)
+    if hasattr(pool.sessions[host].conn, 'timing'):
+        pool.sessions[host].conn.timing = stats.observe
+    telemetry[addr] = RingBuffer(args.history)
+    powerSupplies[addr] = ps
+    logger.info(f'Found power supply {addr} ({type(ps).__name__}) at {host} gpib address {gpibAddr}')
+
+nextSearch = {}
+searchDelay = {}
+
+async def prober(interval):
+    """Every interval, probe the supplies whose breaker is open and look for the ones that were not found"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        jobs = [submitJob(pool.hostOf(addr), partial(probe, addr))
+                for addr,h in health.items() if powerSupplies[addr] is not None and h.probeDue()]
+        now = time.monotonic()
+        for addr,ps in powerSupplies.items():
+            if ps is None and now >= nextSearch.get(addr, 0):
+                #search less often the longer a supply stays missing, it may be served by another worker
+                searchDelay[addr] = min(2*searchDelay.get(addr, interval/2.), 64*interval)
+                nextSearch[addr] = now+searchDelay[addr]
+                jobs.append(loop.run_in_executor(probeExecutor, rediscover, addr))
+        for result in await asyncio.gather(*jobs, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"Probe failed: {result}")
+
+async def poller(interval):
+    """Read every supply each interval seconds into its ring buffer, skipping missed slots"""
+    loop = asyncio.get_running_loop()
+    nextPoll = loop.time()
+    while True:
+        hosts = list(pool.sessions)
+        results = await asyncio.gather(*[submitJob(host, partial(pool.callHost, host, readGuarded))
+                                         for host in hosts], return_exceptions=True)
+        for host,result in zip(hosts, results):
+            if isinstance(result, Exception):
+                logger.error(f"Polling {host} failed: {result}")
+            else:
+                recordSamples(result)
+        nextPoll += interval
+        if nextPoll < loop.time():
+            nextPoll = loop.time()
+        await asyncio.sleep(nextPoll-loop.time())
+
+def workerInfo():
+    return json.dumps({'addresses': [addr for addr,ps in powerSupplies.items() if ps is not None],
+                       'controllers': list(pool.sessions)}).encode()
+
+async def serveWorker(endpoint, pending):
+    """
+    Take requests from gpib_broker over a DEALER socket, sending a heartbeat with the supplies
+    served every HEARTBEAT_INTERVAL and registering again if the broker goes quiet
+    """
+    context = zmq.asyncio.Context.instance()
+    loop = asyncio.get_running_loop()
+    identity = f'{sockets.gethostname()}:{os.getpid()}'.encode()
+    while True:
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.IDENTITY, identity)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(endpoint)
+        logger.info(f"Registering with broker at {endpoint}")
+        lastHeard = loop.time()
+        nextBeat = loop.time()
+        try:
+            while loop.time()-lastHeard < HEARTBEAT_LIVENESS*HEARTBEAT_INTERVAL:
+                if loop.time() >= nextBeat:
+                    await socket.send_multipart([b'', HEARTBEAT, workerInfo()])
+                    nextBeat = loop.time()+HEARTBEAT_INTERVAL
+                if not await socket.poll(max(nextBeat-loop.time(), 0)*1e3):
+                    continue
+                frames = await socket.recv_multipart()
+                lastHeard = loop.time()
+                if frames[1:2]==[HEARTBEAT]:
+                    continue
+                task = asyncio.create_task(handleRequest(socket, frames[1:], prefix=[b'']))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            logger.error("Broker not responding, registering again")
+        except asyncio.CancelledError:
+            await socket.send_multipart([b'', DISCONNECT])
+            raise
+        finally:
+            socket.close()
+
+async def serve(port):
+    global publisher, eventLoop
+    context = zmq.asyncio.Context()
+    eventLoop = asyncio.get_running_loop()
+    if args.pub_port:
+        publisher = zmq.Context.instance().socket(zmq.PUB)
+        if '://' in args.pub_port:
+            publisher.connect(args.pub_port)
+        else:
+            publisher.bind("tcp://*:%s" % args.pub_port)
+    pending = set()
+    if args.poll_interval > 0:
+        pending.add(asyncio.create_task(poller(args.poll_interval)))
+    if args.probe_interval > 0:
+        pending.add(asyncio.create_task(prober(args.probe_interval)))
+    if args.broker:
+        try:
+            await serveWorker(args.broker, pending)
+        finally:
+            if publisher is not None:
+                publisher.close()
+        return
+    socket = context.socket(zmq.ROUTER)
+    socket.bind("tcp://*:%s" % port)
+    try:
+        while True:
+            #  Wait for next request from client
+            frames = await socket.recv_multipart()
+            task = asyncio.create_task(handleRequest(socket, frames))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    finally:
+        socket.close()
+        if publisher is not None:
+            publisher.close()
+
+port = args.port
 
 logger.info('-'*30)
-logger.info(f"Staring server on port {port}")
+if args.broker:
+    logger.info(f"Starting worker for broker {args.broker}")
+else:
+    logger.info(f"Staring server on port {port}")
 logger.info('-'*30)
 try:
-    while True:
-        #  Wait for next request from client
-        message = socket.recv_string()
-        output=gpib_call(message)
-        socket.send_string(f"{output}")
+    asyncio.run(serve(port))
 except KeyboardInterrupt:
-    socket.close()
+    pool.closeAll()
     logger.info('-'*30)
     logger.info(f"Stopping server after keyboard interrupt")
     logger.info('-'*30)
+    logListener.stop()
 except Exception as e:
-    socket.close()
+    pool.closeAll()
     logger.info('-'*30)
     logger.error(f"Received exception {e}")
     logger.error(f"Stopping server")
     logger.info('-'*30)
-    
+    logListener.stop()
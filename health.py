@@ -0,0 +1,89 @@
+"""
+Per-device health for gpib_server: a circuit breaker that fails requests fast while a device
+is not answering, and a read timeout adapted from the latency the device has shown.
+
+The breaker opens after a run of failures.  While it is open, requests are refused without
+touching the bus and only a background probe talks to the device; a good probe closes it.
+"""
+import time
+import threading
+from plx_gpib_ethernet import PrologixGPIBEthernet
+
+CLOSED, OPEN, PROBING = 'closed', 'open', 'probing'
+
+class DeviceHealth:
+    """
+    failures consecutive failures open the breaker, probes are then due every probe_interval
+    seconds.  Until min_samples good replies have been seen the timeout is the fixed
+    timeout, afterwards it follows the latency estimate within min_timeout..max_timeout
+    (the Prologix accepts 1 ms to 3 s).
+    """
+    def __init__(self, failures=3, probe_interval=5., timeout=1., min_timeout=0.1, max_timeout=3., min_samples=5):
+        self.maxFailures = failures
+        self.probeInterval = probe_interval
+        self.defaultTimeout = timeout
+        self.minTimeout = max(min_timeout, 1e-3)
+        self.maxTimeout = min(max_timeout, 3.)
+        self.minSamples = min_samples
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.openedAt = 0.
+        self.samples = 0
+        self.srtt = 0.
+        self.rttvar = 0.
+
+    def allow(self):
+        """True if a request may go to the device"""
+        return self.state == CLOSED
+
+    def probeDue(self):
+        """True, and the breaker marked as probing, if the device is down and due another try"""
+        with self.lock:
+            if self.state == OPEN and time.monotonic()-self.openedAt >= self.probeInterval:
+                self.state = PROBING
+                return True
+            return False
+
+    def record(self, seconds, ok, sample=True):
+        """Outcome of a command that took seconds; sample=False keeps it out of the latency estimate"""
+        with self.lock:
+            if ok:
+                self.failures = 0
+                self.state = CLOSED
+                if sample:
+                    self._observe(seconds)
+                return
+            self.failures += 1
+            if self.state == PROBING or self.failures >= self.maxFailures:
+                self.state = OPEN
+                self.openedAt = time.monotonic()
+
+    def _observe(self, seconds):
+        #smoothed latency and its deviation, as TCP estimates round trip times (RFC 6298)
+        if self.samples == 0:
+            self.srtt, self.rttvar = seconds, seconds/2.
+        else:
+            self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt-seconds)
+            self.srtt = 0.875*self.srtt + 0.125*seconds
+        self.samples += 1
+
+    def timeout(self):
+        if self.samples < self.minSamples:
+            return self.defaultTimeout
+        return min(self.maxTimeout, max(self.minTimeout, 2*(self.srtt+4*self.rttvar)))
+
+    def snapshot(self):
+        return {'state': self.state, 'failures': self.failures, 'timeout_ms': self.timeout()*1e3,
+                'latency_ms': self.srtt*1e3 if self.samples else None}
+
+
+def applyTimeout(ps, seconds):
+    """Use seconds as the read timeout for the next commands to ps"""
+    conn = getattr(ps, 'gpib', None)
+    if isinstance(conn, PrologixGPIBEthernet):
+        #sent as ++read_tmo_ms with the next command when it changes
+        conn.set_timeout(seconds)
+    elif hasattr(ps, 'socket'):
+        ps.socket.settimeout(seconds)
+        ps.timeout = seconds
@@ -0,0 +1,188 @@
+import time
+import select
+import socket
+import threading
+from contextlib import contextmanager
+from PowerSupplyControls import gpibControl
+
+
+class PooledSession:
+    """
+    One persistent connection to a controller host.  For GPIB supplies this is the
+    PrologixGPIBEthernet shared by every address behind that box, for socket supplies
+    (Siglent, TTi) it is the driver itself.
+    """
+    def __init__(self, host, conn, timing=None):
+        self.host = host
+        self.conn = conn
+        self.timing = timing
+        self.lock = threading.RLock()
+        self.isOpen = False
+        self.lastUsed = 0.
+        #set after a timeout, a late reply may still arrive and has to be drained
+        self.stale = False
+        #GPIB addresses behind a Prologix session, each released to local mode on its own
+        self.addrs = []
+
+    def open(self):
+        t = time.perf_counter()
+        self.conn.reconnect()
+        self.isOpen = True
+        if self.timing is not None:
+            self.timing(self.host, 'session_open', time.perf_counter()-t)
+
+    def drop(self):
+        """Close the socket without talking to the instrument (used after errors)"""
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        self.isOpen = False
+
+    def release(self):
+        """Return the instrument to local mode and close the socket"""
+        try:
+            if self.addrs:
+                self.conn.disconnect(self.addrs)
+            else:
+                self.conn.disconnect()
+        except OSError:
+            pass
+        self.drop()
+
+    def alive(self):
+        #a socket closed by the peer selects as readable and peeks as b''
+        #anything else waiting on an idle socket is a stale reply, so discard it
+        sock = self.conn.socket
+        if hasattr(self.conn, 'reader'):
+            self.conn.reader.clear()
+        try:
+            while True:
+                readable,_,_ = select.select([sock],[],[],0)
+                if not readable:
+                    return True
+                if sock.recv(4096) == b'':
+                    return False
+        except (OSError, ValueError):
+            return False
+
+    def ensureOpen(self, healthInterval):
+        if self.isOpen and (self.stale or time.time()-self.lastUsed > healthInterval) and not self.alive():
+            self.drop()
+        self.stale = False
+        if not self.isOpen:
+            self.open()
+
+
+class InstrumentPool:
+    """
+    Keeps instrument sockets open between requests, keyed by controller host.
+
+    Sessions idle for longer than idle_timeout seconds are released (++loc / *UNLOCK and
+    close) by a background reaper, sessions idle for longer than health_interval are
+    checked before use, and a call failing with a socket error is retried on a fresh
+    connection.  A timeout is the device's problem rather than the connection's, so it is
+    neither retried nor a reason to reconnect the other devices on the controller.
+    timing(device, operation, seconds), if given, is told how long each session took to open.
+    """
+    def __init__(self, idle_timeout=60., health_interval=5., retries=1, timing=None):
+        self.timing = timing
+        self.idleTimeout = idle_timeout
+        self.healthInterval = health_interval
+        self.retries = retries
+        self.devices = {}
+        self.hosts = {}
+        self.sessions = {}
+        self._reaper = None
+        self._stop = threading.Event()
+
+    def add(self, addr, ps):
+        if isinstance(ps, gpibControl):
+            host = ps.gpib.host
+            if host in self.sessions:
+                #reuse the controller socket already owned by the pool
+                if ps.gpib is not self.sessions[host].conn:
+                    ps.gpib.close()
+                ps.gpib = self.sessions[host].conn
+            else:
+                self.sessions[host] = PooledSession(host, ps.gpib, self.timing)
+            if ps.addr not in self.sessions[host].addrs:
+                self.sessions[host].addrs.append(ps.addr)
+        else:
+            host = ps.host
+            self.sessions[host] = PooledSession(host, ps, self.timing)
+        self.devices[addr] = ps
+        self.hosts[addr] = host
+
+    def markStale(self, addr):
+        """A read of addr timed out inside a held session, have the next use drain its socket"""
+        self.sessions[self.hosts[addr]].stale = True
+
+    def hostOf(self, addr):
+        return self.hosts.get(addr)
+
+    def addresses(self, host=None):
+        #devices can be added from another thread, work on a copy
+        return [addr for addr,h in list(self.hosts.items()) if host is None or h==host]
+
+    @contextmanager
+    def session(self, addr):
+        with self.hostSession(self.hosts[addr]):
+            yield self.devices[addr]
+
+    @contextmanager
+    def hostSession(self, host):
+        """The open connection to host, also for talking to addresses not added to the pool yet"""
+        s = self.sessions[host]
+        with s.lock:
+            s.ensureOpen(self.healthInterval)
+            try:
+                yield s.conn
+            except socket.timeout:
+                s.stale = True
+                raise
+            except OSError:
+                s.drop()
+                raise
+            finally:
+                s.lastUsed = time.time()
+
+    def call(self, addr, func):
+        """Run func(ps) on an open session, reconnecting and retrying on socket errors"""
+        for attempt in range(self.retries+1):
+            try:
+                with self.session(addr) as ps:
+                    return func(ps)
+            except socket.timeout:
+                raise
+            except OSError:
+                if attempt==self.retries:
+                    raise
+
+    def callHost(self, host, func):
+        """Run func({addr: ps}) for every device behind host on one open session"""
+        addrs = self.addresses(host)
+        return self.call(addrs[0], lambda ps: func({addr: self.devices[addr] for addr in addrs}))
+
+    def evictIdle(self):
+        now = time.time()
+        for s in list(self.sessions.values()):
+            if s.isOpen and now-s.lastUsed > self.idleTimeout and s.lock.acquire(blocking=False):
+                try:
+                    s.release()
+                finally:
+                    s.lock.release()
+
+    def startReaper(self):
+        def reap():
+            while not self._stop.wait(max(self.idleTimeout/2., 0.1)):
+                self.evictIdle()
+        self._reaper = threading.Thread(target=reap, name='pool-reaper', daemon=True)
+        self._reaper.start()
+
+    def closeAll(self):
+        self._stop.set()
+        for s in list(self.sessions.values()):
+            with s.lock:
+                if s.isOpen:
+                    s.release()
@@ -0,0 +1,427 @@
+#!/usr/bin/python3
+"""
+Local stand-in for the lab instruments, for exercising the drivers and gpib_server
+without hardware.
+
+Simulates Prologix GPIB-Ethernet controllers (port 1234) with Agilent supplies and a
+Keithley meter behind them, Siglent SPD1168X supplies (port 5025) and TTi supplies
+(port 9221).  Every instrument transaction can be given a latency, a random jitter and
+a probability of the reply being dropped.  On Linux every 127.x.x.x address is local,
+so several instruments on the same port can each get their own address.
+"""
+import asyncio
+import random
+import struct
+import threading
+from collections import Counter
+from PowerSupplyControls import knownModelTypes
+
+AGILENT_IDS = {model.split(',')[1]: model for model in knownModelTypes}
+KEITHLEY_ID = 'KEITHLEY INSTRUMENTS INC.,MODEL 2000,0,A20'
+SIGLENT_ID = 'Siglent Technologies,SPD1168X,SPD13DCQ0000,1.01.01.02.05,V3.0'
+TTI_ID = 'THURLBY THANDAR,QL355TP,0,1.0'
+
+def scpi(value):
+    return f'{value:+.8E}'
+
+
+class SimulatedInstrument:
+    """Common SCPI message handling: split on ';', dispatch each command, join the replies"""
+    idn = ''
+    terminator = '\n'
+
+    def __init__(self, load=10.):
+        self.load = load
+        self.online = True
+
+    def handle(self, message):
+        """Process one received line, returning the reply text (without terminator) or None"""
+        replies = []
+        for command in message.split(';'):
+            command = command.strip().lstrip(':')
+            if not command:
+                continue
+            reply = self.command(command.upper(), command)
+            if reply is not None:
+                replies.append(reply)
+        if len(replies) == 1:
+            #may be a binary block (bytes), sent as it is
+            return replies[0]
+        return ';'.join(replies) if replies else None
+
+    def command(self, cmd, raw):
+        if cmd == '*IDN?':
+            return self.idn
+        return None
+
+
+class SimulatedSupply(SimulatedInstrument):
+    """Agilent E36xxA style supply, with INST:SEL for the two output E3648A"""
+    def __init__(self, idn, outputs=1, load=10.):
+        SimulatedInstrument.__init__(self, load)
+        self.idn = idn
+        self.voltage = [0.]*outputs
+        self.current = [1.]*outputs
+        self.output = 0
+        self.on = False
+        self.sense = '2W'
+
+    def measure(self, output):
+        if not self.on:
+            return 0., 0.
+        v = self.voltage[output]
+        i = min(v/self.load, self.current[output])
+        return v + random.gauss(0, 1e-4), i + random.gauss(0, 1e-5)
+
+    def command(self, cmd, raw):
+        arg = cmd.split(' ',1)[1] if ' ' in cmd else ''
+        if cmd.startswith('INST:SEL OUT'):
+            self.output = min(int(cmd[-1])-1, len(self.voltage)-1)
+        elif cmd == 'MEAS:VOLT?':
+            return scpi(self.measure(self.output)[0])
+        elif cmd == 'MEAS:CURR?':
+            return scpi(self.measure(self.output)[1])
+        elif cmd == 'VOLT?':
+            return scpi(self.voltage[self.output])
+        elif cmd == 'CURR?':
+            return scpi(self.current[self.output])
+        elif cmd.startswith('VOLT '):
+            self.voltage[self.output] = float(arg)
+        elif cmd.startswith('CURR '):
+            self.current[self.output] = float(arg)
+        elif cmd in ('OUTP:STAT?', 'OUTP?'):
+            return str(int(self.on))
+        elif cmd.startswith('OUTP '):
+            self.on = arg in ('ON', '1')
+        elif cmd == '*RST':
+            SimulatedSupply.__init__(self, self.idn, len(self.voltage), self.load)
+        else:
+            return SimulatedInstrument.command(self, cmd, raw)
+        return None
+
+
+class SimulatedSiglent(SimulatedSupply):
+    def __init__(self, load=10.):
+        SimulatedSupply.__init__(self, SIGLENT_ID, 1, load)
+
+    def command(self, cmd, raw):
+        if cmd == 'SYST:STAT?':
+            #bit 4 is the CH1 output state, bit 5 the 4W sense mode
+            return hex((self.on<<4) | ((self.sense=='4W')<<5))
+        if cmd.startswith('OUTP CH1,'):
+            self.on = cmd.endswith('ON')
+        elif cmd.startswith('MOE:SET '):
+            self.sense = cmd.split(' ')[1]
+        elif cmd == '*UNLOCK':
+            pass
+        else:
+            return SimulatedSupply.command(self, cmd, raw)
+        return None
+
+
+class SimulatedTTi(SimulatedSupply):
+    terminator = '\r\n'
+
+    def __init__(self, load=10.):
+        SimulatedSupply.__init__(self, TTI_ID, 3, load)
+
+    def command(self, cmd, raw):
+        head, _, arg = cmd.partition(' ')
+        if head[:1] in 'VI' and head[1:2].isdigit():
+            n = int(head[1])-1
+            values = self.voltage if head[0]=='V' else self.current
+            if head.endswith('O?'):
+                self.output = n
+                v,i = self.measure(n)
+                return f'{v:.3f}V' if head[0]=='V' else f'{i:.4f}A'
+            if head.endswith('?'):
+                return f'{head[:2]} {values[n]:.3f}'
+            values[n] = float(arg)
+        elif head.startswith('OP') and head[2:3].isdigit():
+            if head.endswith('?'):
+                return str(int(self.on))
+            self.on = arg=='1'
+        elif cmd == '*UNLOCK':
+            pass
+        else:
+            return SimulatedInstrument.command(self, cmd, raw)
+        return None
+
+
+class SimulatedKeithley(SimulatedInstrument):
+    """Keithley 2000 style meter reading an RTD (FRES) or a current (CURR:DC)"""
+    def __init__(self, temperature=25., current=0.1):
+        SimulatedInstrument.__init__(self)
+        self.idn = KEITHLEY_ID
+        self.temperature = temperature
+        self.current = current
+        self.function = 'FRES'
+        #readings per INIT and the buffer they are stored in
+        self.count = 1
+        self.buffer = []
+        self.format = 'ASC'
+        self.swapped = False
+
+    def sample(self):
+        if self.function == 'FRES':
+            return 1000.*(1+0.00385*self.temperature) + random.gauss(0, 0.01)
+        return self.current + random.gauss(0, 1e-5)
+
+    def command(self, cmd, raw):
+        if cmd.startswith('FUNC '):
+            self.function = cmd.split(' ',1)[1].strip("'\"")
+        elif cmd in ('READ?', 'FETC?', 'MEAS?'):
+            return scpi(self.sample())
+        elif cmd.startswith('TRIG:COUN '):
+            self.count = int(float(cmd.split(' ',1)[1]))
+        elif cmd == 'INIT':
+            self.buffer = [self.sample() for _ in range(self.count)]
+        elif cmd == 'TRAC:CLE':
+            self.buffer = []
+        elif cmd == 'TRAC:DATA?':
+            if self.format == 'ASC':
+                return ','.join(scpi(value) for value in self.buffer)
+            #SREal/DREal as an IEEE 488.2 indefinite length block, as the 2000 sends it, with its NL terminator
+            data = struct.pack(('<' if self.swapped else '>') + ('f' if self.format.startswith('SRE') else 'd')*len(self.buffer), *self.buffer)
+            return b'#0%s\n' % data
+        elif cmd.startswith('FORM:DATA '):
+            self.format = cmd.split(' ',1)[1][:3]
+        elif cmd.startswith('FORM:BORD '):
+            self.swapped = cmd.endswith('SWAP')
+        elif cmd == '*OPC?':
+            return '1'
+        elif cmd.startswith(('TRAC:', 'TRIG:', 'SAMP:', 'FORM:')):
+            pass
+        elif cmd == '*RST':
+            self.function = 'FRES'
+            self.count = 1
+            self.buffer = []
+            self.format = 'ASC'
+            self.swapped = False
+        else:
+            return SimulatedInstrument.command(self, cmd, raw)
+        return None
+
+
+class Simulator:
+    """
+    Runs the simulated endpoints on an asyncio loop in a background thread.
+
+    latency and jitter (seconds) are added to every instrument transaction, dropout is
+    the probability that a reply is lost.  counters[host] counts instrument writes and
+    reads, controller (++) commands and connections, for measuring bus transactions.
+    """
+    def __init__(self, latency=0., jitter=0., dropout=0., seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.dropout = dropout
+        self.random = random.Random(seed)
+        self.endpoints = []
+        self.counters = {}
+        self.loop = None
+        self.servers = []
+        self.connections = set()
+        self.thread = None
+
+    def addPrologix(self, host, devices, port=1234):
+        """devices is {gpib address: SimulatedInstrument}"""
+        self.endpoints.append((host, port, self._prologix, devices))
+        self.counters[host] = Counter()
+        return devices
+
+    def addSiglent(self, host, port=5025):
+        device = SimulatedSiglent()
+        self.endpoints.append((host, port, self._socketInstrument, device))
+        self.counters[host] = Counter()
+        return device
+
+    def addTTi(self, host, port=9221):
+        device = SimulatedTTi()
+        self.endpoints.append((host, port, self._socketInstrument, device))
+        self.counters[host] = Counter()
+        return device
+
+    async def _delay(self, limit=None):
+        """Wait out one transaction, or limit seconds if it is shorter; False if limit ran out"""
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if limit is not None and delay > limit:
+            await asyncio.sleep(limit)
+            return False
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return True
+
+    def _dropped(self):
+        return self.dropout > 0 and self.random.random() < self.dropout
+
+    async def _prologix(self, devices, host, reader, writer):
+        counter = self.counters[host]
+        counter['connections'] += 1
+        state = {'addr': None, 'auto': 0, 'read_tmo_ms': 1000}
+        pending = {}
+        async def respond(addr):
+            #the controller gives up on an instrument slower than its read timeout, and the reply is lost
+            inTime = await self._delay(state['read_tmo_ms']/1e3)
+            counter['reads'] += 1
+            device = devices.get(addr)
+            reply = pending.pop(addr, None)
+            if not inTime:
+                return
+            if device is None or not device.online or reply is None or self._dropped():
+                #nothing to read: the controller waits out its read timeout
+                await asyncio.sleep(state['read_tmo_ms']/1e3)
+                return
+            writer.write(reply if isinstance(reply, bytes) else (reply + device.terminator).encode('ascii'))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('ascii', 'replace').strip()
+                if line.startswith('++'):
+                    counter['controller'] += 1
+                    cmd, _, arg = line[2:].partition(' ')
+                    if cmd == 'addr':
+                        if arg:
+                            state['addr'] = int(arg)
+                        else:
+                            writer.write(f"{state['addr']}\n".encode('ascii'))
+                    elif cmd == 'read':
+                        await respond(state['addr'])
+                    elif cmd in ('auto', 'read_tmo_ms'):
+                        state[cmd] = int(arg)
+                    elif cmd == 'ver':
+                        writer.write(b'Prologix GPIB-ETHERNET Controller version 01.06.06.00 (simulated)\n')
+                    continue
+                device = devices.get(state['addr'])
+                counter['writes'] += 1
+                await self._delay()
+                if device is not None and device.online:
+                    reply = device.handle(line)
+                    if reply is not None:
+                        pending[state['addr']] = reply
+                #a real controller reads back after every instrument line while ++auto is 1,
+                #waiting out its read timeout when the instrument has nothing to say
+                if state['auto']:
+                    await respond(state['addr'])
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _socketInstrument(self, device, host, reader, writer):
+        counter = self.counters[host]
+        counter['connections'] += 1
+        try:
+            if not device.online:
+                return
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                counter['writes'] += 1
+                await self._delay()
+                reply = device.handle(line.decode('ascii', 'replace').strip())
+                if reply is not None and not self._dropped():
+                    counter['reads'] += 1
+                    writer.write((reply + device.terminator).encode('ascii'))
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _serve(self, handler, target, host, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            await handler(target, host, reader, writer)
+        except asyncio.CancelledError:
+            #stopping the simulator, the handler has already closed its socket
+            pass
+        finally:
+            self.connections.discard(task)
+
+    async def _start(self):
+        for host, port, handler, target in self.endpoints:
+            serve = lambda r, w, handler=handler, target=target, host=host: self._serve(handler, target, host, r, w)
+            self.servers.append(await asyncio.start_server(serve, host, port, reuse_address=True))
+
+    def start(self):
+        """Start serving in a background thread, returning once every endpoint is listening"""
+        started = threading.Event()
+        errors = []
+        def run():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.loop.run_until_complete(self._start())
+            except OSError as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            self.loop.run_forever()
+        self.thread = threading.Thread(target=run, name='instrument-simulator', daemon=True)
+        self.thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        return self
+
+    def stop(self):
+        async def close():
+            for server in self.servers:
+                server.close()
+            for task in list(self.connections):
+                task.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            self.loop.stop()
+        asyncio.run_coroutine_threadsafe(close(), self.loop)
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+MODELS = {'E3648A': lambda: SimulatedSupply(AGILENT_IDS['E3648A'], outputs=2),
+          'E3642A': lambda: SimulatedSupply(AGILENT_IDS['E3642A']),
+          'E3633A': lambda: SimulatedSupply(AGILENT_IDS['E3633A']),
+          'DMM': SimulatedKeithley}
+
+def parseController(spec):
+    """'127.0.0.50:2=E3648A,4=E3642A,14=DMM' -> (host, {2: supply, 4: supply, 14: meter})"""
+    host, _, devices = spec.partition(':')
+    return host, {int(addr): MODELS[model]() for addr,model in (d.split('=') for d in devices.split(','))}
+
+
+if __name__=='__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prologix', default=['127.0.0.50:2=E3648A,3=E3642A,4=E3633A,6=E3648A,8=E3642A,14=DMM'], nargs='*', help=f'Controllers as host:addr=model,... with models {",".join(MODELS)}')
+    parser.add_argument('--siglent', default=[], nargs='*', help='IP addresses of simulated Siglent supplies')
+    parser.add_argument('--tti', default=[], nargs='*', help='IP addresses of simulated TTi supplies')
+    parser.add_argument('--latency', default=0.002, type=float, help='Seconds added to every instrument transaction')
+    parser.add_argument('--jitter', default=0.001, type=float, help='Random extra latency, up to this many seconds')
+    parser.add_argument('--dropout', default=0., type=float, help='Probability of a reply being lost')
+    parser.add_argument('--seed', default=None, type=int)
+    args = parser.parse_args()
+
+    sim = Simulator(args.latency, args.jitter, args.dropout, args.seed)
+    for spec in args.prologix:
+        sim.addPrologix(*parseController(spec))
+    for host in args.siglent:
+        sim.addSiglent(host)
+    for host in args.tti:
+        sim.addTTi(host)
+    with sim:
+        print(f'Simulating {len(sim.endpoints)} endpoints, Ctrl-C to stop')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
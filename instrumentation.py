@@ -0,0 +1,84 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# histogram bucket upper bounds in seconds, from 100 us up to the 3 s Prologix timeout limit
+BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1., 2.5, 5., float('inf'))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0]*len(BUCKETS)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile"""
+        if self.count == 0:
+            return float('nan')
+        rank = q*self.count
+        seen = 0
+        for bound,n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Stats:
+    """
+    Timing histograms keyed by (device, operation).  observe() is cheap enough to call on
+    every bus transaction; snapshot() and prometheus() report what was collected.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def observe(self, device, operation, seconds):
+        key = (str(device), operation)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, device, operation):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(device, operation, time.perf_counter()-t)
+
+    def snapshot(self):
+        with self.lock:
+            items = [(key, h.count, h.sum, h.max, h.quantile(0.5), h.quantile(0.99)) for key,h in self.histograms.items()]
+        output = {'uptime': time.time()-self.started, 'devices': {}}
+        for (device,operation),count,total,slowest,p50,p99 in sorted(items):
+            output['devices'].setdefault(device, {})[operation] = {
+                'count': count, 'mean_ms': total/count*1e3, 'p50_ms': p50*1e3, 'p99_ms': p99*1e3, 'max_ms': slowest*1e3}
+        return output
+
+    def prometheus(self, name='gpib_operation_seconds'):
+        """Prometheus text exposition of every histogram"""
+        lines = [f'# HELP {name} Time spent in instrument operations',
+                 f'# TYPE {name} histogram']
+        with self.lock:
+            for (device,operation),h in sorted(self.histograms.items()):
+                labels = f'device="{device}",operation="{operation}"'
+                cumulative = 0
+                for bound,n in zip(BUCKETS, h.counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{labels}}} {h.sum}')
+                lines.append(f'{name}_count{{{labels}}} {h.count}')
+        return '\n'.join(lines)+'\n'
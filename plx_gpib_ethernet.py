@@ -1,79 +1,380 @@
 
 #### script from https://github.com/nelsond/prologix-gpib-ethernet
 
+import re
 import socket
+import time
+from contextlib import contextmanager
+
+
+class TerminatedReader:
+    """
+    Receive buffer for terminator-delimited instrument replies.
+
+    Data is read with recv_into into one reusable bytearray, each call returns exactly one
+    reply (terminator included, so callers can keep stripping it themselves) and any bytes
+    after it are kept for the next call.
+    """
+    def __init__(self, size=4096, terminator=b'\n'):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.terminator = terminator
+        self.start = 0
+        self.end = 0
+
+    def clear(self):
+        self.start = 0
+        self.end = 0
+
+    def readline(self, sock):
+        searchFrom = self.start
+        while True:
+            i = self.buffer.find(self.terminator, searchFrom, self.end)
+            if i >= 0:
+                i += len(self.terminator)
+                value = str(self.view[self.start:i], 'ascii')
+                self.start = i
+                if self.start == self.end:
+                    self.clear()
+                return value
+            searchFrom = max(self.start, self.end-len(self.terminator)+1)
+            searchFrom -= self._fill(sock)
+
+    def readBlock(self, sock, out=None, length=None):
+        """
+        Read one IEEE 488.2 binary block, #<digits><length><data>, and the response
+        terminator after it.  The data is received straight into out (any writable buffer at
+        least length bytes long, e.g. a reused bytearray or NumPy array) or a new bytearray,
+        and returned as a memoryview of it, without decoding or further copies.
+        Indefinite length blocks, #0<data>, are only read when the caller gives their length.
+        """
+        self._need(sock, 2)
+        if self.buffer[self.start] != ord('#'):
+            raise ValueError('Expected a binary block, got %r' % self.readline(sock).strip())
+        digits = self.buffer[self.start+1]-ord('0')
+        if digits == 0 and length is not None:
+            self.start += 2
+        elif 1 <= digits <= 9:
+            self._need(sock, 2+digits)
+            length = int(bytes(self.view[self.start+2:self.start+2+digits]))
+            self.start += 2+digits
+        else:
+            # #0 blocks run up to a NL^END that the data may contain, there is no telling where they stop
+            self.clear()
+            raise ValueError('Indefinite length binary blocks need their length')
+        view = memoryview(bytearray(length) if out is None else out).cast('B')
+        if len(view) < length:
+            self.clear()
+            raise ValueError('%i byte block does not fit in a %i byte buffer' % (length, len(view)))
+        view = view[:length]
+        n = min(length, self.end-self.start)
+        view[:n] = self.view[self.start:self.start+n]
+        self.start += n
+        if self.start == self.end:
+            self.clear()
+        # the rest goes from the socket straight into the caller's buffer
+        try:
+            while n < length:
+                received = sock.recv_into(view[n:])
+                if received == 0:
+                    raise ConnectionError('Connection closed by instrument')
+                n += received
+        except (socket.timeout, ConnectionError):
+            self.clear()
+            raise
+        # NL^END response terminator
+        self.readline(sock)
+        return view
+
+    def _need(self, sock, n):
+        while self.end-self.start < n:
+            self._fill(sock)
+
+    def _fill(self, sock):
+        #returns how far the unread data moved towards the start of the buffer
+        shift = 0
+        if self.end == len(self.buffer):
+            if self.start > 0:
+                shift = self.start
+                self.buffer[:self.end-self.start] = self.view[self.start:self.end]
+                self.start, self.end = 0, self.end-self.start
+            else:
+                self.view.release()
+                self.buffer.extend(bytes(len(self.buffer)))
+                self.view = memoryview(self.buffer)
+        try:
+            n = sock.recv_into(self.view[self.end:])
+        except socket.timeout:
+            #drop the partial reply rather than prepend it to the next one
+            self.clear()
+            raise
+        if n == 0:
+            self.clear()
+            raise ConnectionError('Connection closed by instrument')
+        self.end += n
+        return shift
+
+
+# seconds the socket waits beyond ++read_tmo_ms, so that by the time the socket times out the
+# controller has given up on the instrument and no late reply is on its way
+SOCKET_MARGIN = 0.1
+
+# bytes the controller would take as the end of a command or a ++ command, unless escaped
+ESCAPED = re.compile(b'([\n\r\x1b+])')
+
+# numpy dtypes of SCPI FORMat:DATA REAL,32 / REAL,64 in the default NORMal (big endian) byte order
+REAL_FORMATS = {'REAL,32': '>f4', 'REAL,64': '>f8'}
+
+
+def block(data):
+    """IEEE 488.2 definite length block holding data"""
+    length = b'%i' % len(data)
+    return b'#%i%s%s' % (len(length), length, data)
 
 
 class PrologixGPIBEthernet:
     PORT = 1234
 
-    def __init__(self, host, timeout=1):
+    def __init__(self, host, timeout=1, auto=False):
         self.host = host
-        self.socket = socket.socket(socket.AF_INET,
-                                    socket.SOCK_STREAM,
-                                    socket.IPPROTO_TCP)
+        self.socket = self._newSocket()
+        self.reader = TerminatedReader()
+        # with ++auto 1 the controller reads back after every line it passes on, so query() needs
+        # no ++read, but a plain write would cost a read timeout on an instrument with nothing
+        # to say.  With auto, ++auto is only left on for single query lines: it is switched
+        # off, in the same sendall, before anything else goes to the instrument
+        self.auto = auto
+        # ++auto state of the controller, None when unknown
+        self.autoState = None
+        # lines waiting to go out in one sendall, and how many batch() blocks are open
+        self.pending = []
+        self.batching = 0
+        # GPIB address the controller is currently talking to, None when unknown
+        self.addr = None
+        # optional callback timing(device, operation, seconds) for every socket operation
+        self.timing = None
         self.timeout = 0
         self.set_timeout(timeout)
+        # counts (re)connections, so users of a shared connection can tell it was reopened
+        self.connections = 0
+
+    def _newSocket(self):
+        sock = socket.socket(socket.AF_INET,
+                             socket.SOCK_STREAM,
+                             socket.IPPROTO_TCP)
+        # every flush is a whole transaction, so there is nothing for Nagle to gain by waiting
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
 
     def connect(self):
+        self.reader.clear()
+        self.pending = []
+        self.addr = None
+        self.autoState = None
+        t = time.perf_counter()
         self.socket.connect((self.host, self.PORT))
+        self.connections += 1
+        self._timed('connect', t)
 
         self._setup()
 
     def reconnect(self):
         self.socket.close()
-        self.socket = socket.socket(socket.AF_INET,
-                                    socket.SOCK_STREAM,
-                                    socket.IPPROTO_TCP)
+        self.reader.clear()
+        self.pending = []
+        self.addr = None
+        self.autoState = None
+        self.socket = self._newSocket()
+        self.socket.settimeout(self.timeout + SOCKET_MARGIN)
+        t = time.perf_counter()
         self.socket.connect((self.host, self.PORT))
+        self.connections += 1
+        self._timed('connect', t)
 
     def close(self):
         self.socket.close()
+        self.pending = []
+        self.addr = None
 
-    def disconnect(self):
-        self._send('++loc')
+    def disconnect(self, addrs=()):
+        # ++loc only returns the addressed device to local mode, so address each of addrs in turn
+        for addr in addrs:
+            self.select(addr)
+            self._queue('++loc')
+        if not addrs:
+            self._queue('++loc')
+        self.flush(force=True)
 
     def select(self, addr):
-        self._send('++addr %i' % int(addr))
+        # skip ++addr when the controller is already addressing this device, otherwise
+        # queue it to go out with the next command
+        if self.addr != int(addr):
+            self.addr = int(addr)
+            self._queue('++addr %i' % int(addr))
 
     def write(self, cmd):
-        self._send(cmd)
+        self._queueWrite(cmd)
+        self.flush()
 
     def read(self, num_bytes=1024):
-        self._send('++read eoi')
+        self._queue('++read eoi')
+        self.flush(force=True)
         return self._recv(num_bytes)
 
+    def write_block(self, cmd, data):
+        """Send cmd followed by data (bytes or any buffer) as a definite length binary block"""
+        # the controller passes ESC, CR, LF and + on when preceded by ESC
+        value = cmd.encode('ascii') + b' ' + ESCAPED.sub(b'\x1b\\1', block(bytes(data))) + b'\n'
+        self._queueWrite(value)
+        self.flush()
+
+    def read_block(self, out=None, length=None):
+        """Binary block reply as a memoryview, of out when given; length is needed for #0 blocks"""
+        self._queue('++read eoi')
+        self.flush(force=True)
+        return self._recv(length, out=out, binary=True)
+
+    def query_block(self, cmd, out=None, length=None):
+        if self.auto:
+            self._queueQuery(cmd)
+            self.flush(force=True)
+            return self._recv(length, out=out, binary=True)
+        self._queue(cmd)
+        return self.read_block(out, length)
+
+    def query_array(self, cmd, dtype='REAL,32', out=None, count=None):
+        """
+        Binary block reply as a NumPy array sharing memory with the received data (or out),
+        dtype is 'REAL,32', 'REAL,64' or any numpy dtype matching the instrument's format.
+        count, the number of values expected, lets indefinite length (#0) replies be read.
+        """
+        import numpy as np
+        dtype = np.dtype(REAL_FORMATS.get(dtype, dtype))
+        length = None if count is None else count*dtype.itemsize
+        return np.frombuffer(self.query_block(cmd, out, length), dtype)
+
     def query(self, cmd, buffer_size=1024*1024):
-        self.write(cmd)
+        if self.auto:
+            self._queueQuery(cmd)
+            self.flush(force=True)
+            return self._recv(buffer_size)
+        self._queue(cmd)
         return self.read(buffer_size)
 
+    @contextmanager
+    def batch(self):
+        """
+        Hold writes back and send them in one sendall when the block ends, e.g.
+
+            with gpib.batch():
+                gpib.write('VOLT 1.2')
+                gpib.write('CURR 0.6')
+
+        A read inside the block flushes what was queued before it.
+        """
+        self.batching += 1
+        try:
+            yield self
+        except BaseException:
+            # do not let half a batch go out with whatever is sent next
+            if self.batching == 1:
+                self.pending = []
+                self.addr = None
+                self.autoState = None
+            raise
+        finally:
+            self.batching -= 1
+        self.flush()
+
+    def flush(self, force=False):
+        if not self.pending or (self.batching and not force):
+            return
+        lines, self.pending = self.pending, []
+        # binary writes are queued as bytes, already escaped and terminated
+        data = b''.join(line if isinstance(line, bytes) else ('%s\n' % line).encode('ascii') for line in lines)
+        t = time.perf_counter()
+        try:
+            self.socket.sendall(data)
+        except OSError:
+            # the ++addr or ++auto may not have arrived
+            self.addr = None
+            self.autoState = None
+            raise
+        if self.timing is not None:
+            self._timed(self._operation(lines), t)
+
     def set_timeout(self, timeout):
         # see user manual for details on accepted timeout values
         # https://prologix.biz/downloads/PrologixGpibEthernetManual.pdf#page=13
         if timeout < 1e-3 or timeout > 3:
             raise ValueError('Timeout must be >= 1e-3 (1ms) and <= 3 (3s)')
 
+        # a different GPIB read timeout goes to the controller with the next command
+        if self.timeout and int(timeout*1e3) != int(self.timeout*1e3):
+            self._queue('++read_tmo_ms %i' % int(timeout*1e3))
         self.timeout = timeout
-        self.socket.settimeout(self.timeout)
+        self.socket.settimeout(self.timeout + SOCKET_MARGIN)
+
+    def _timed(self, operation, start):
+        if self.timing is not None:
+            self.timing('%s/%s' % (self.host, self.addr), operation, time.perf_counter()-start)
+
+    def _operation(self, lines):
+        # name a flush after its instrument command, or the controller command if it has none
+        names = ['write' if isinstance(line, bytes) or not line.startswith('++') else line[2:].split(' ')[0] for line in lines]
+        return 'write' if 'write' in names else names[-1]
+
+    def _queue(self, value):
+        self.pending.append(value)
+
+    def _setAuto(self, state):
+        if self.autoState != state:
+            self.autoState = state
+            self._queue('++auto %i' % state)
+
+    def _queueWrite(self, value):
+        # an instrument line that is not to be read back
+        if self.auto:
+            self._setAuto(0)
+        self._queue(value)
+
+    def _queueQuery(self, cmd):
+        # lines before the last one of a multi-line query are plain writes, only the last is read back
+        lines = cmd.split('\n')
+        for line in lines[:-1]:
+            self._queueWrite(line)
+        self._setAuto(1)
+        self._queue(lines[-1])
 
     def _send(self, value):
-        encoded_value = ('%s\n' % value).encode('ascii')
-        self.socket.send(encoded_value)
+        self._queue(value)
+        self.flush(force=True)
 
-    def _recv(self, byte_num):
-        value = self.socket.recv(byte_num)
-        return value.decode('ascii')
+    def _recv(self, byte_num, out=None, binary=False):
+        t = time.perf_counter()
+        try:
+            if binary:
+                value = self.reader.readBlock(self.socket, out, byte_num)
+            else:
+                value = self.reader.readline(self.socket)
+        except socket.timeout:
+            self._timed('read_timeout', t)
+            raise
+        self._timed('read', t)
+        return value
 
     def _setup(self):
-        # set device to CONTROLLER mode
-        self._send('++mode 1')
+        with self.batch():
+            # set device to CONTROLLER mode
+            self._queue('++mode 1')
 
-        # disable read after write
-        self._send('++auto 0')
+            # read after write only when asked for, and then only for queries
+            self._queue('++auto 0')
+            self.autoState = 0
 
-        # set GPIB timeout
-        self._send('++read_tmo_ms %i' % int(self.timeout*1e3))
+            # set GPIB timeout
+            self._queue('++read_tmo_ms %i' % int(self.timeout*1e3))
 
-        # do not require CR or LF appended to GPIB data
-        self._send('++eos 3')
+            # do not require CR or LF appended to GPIB data
+            self._queue('++eos 3')
 
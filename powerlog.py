@@ -0,0 +1,186 @@
+"""
+Append-only binary log of power supply readings.
+
+A log file is a 16 byte header followed by fixed-width 32 byte records
+(time, device, on/off, voltage, current), so it can be memory-mapped as a NumPy
+structured array.  Next to it, <log>.idx holds the first record number and the
+time range of every completed block of BLOCK_SIZE records, which lets a time-range
+query read only the blocks that overlap it.
+"""
+import os
+import re
+import struct
+import threading
+from datetime import datetime
+
+MAGIC = b'PWRLOG1\0'
+HEADER = struct.Struct('<8sI4x')
+RECORD = struct.Struct('<dHb5xdd')
+INDEX = struct.Struct('<Qdd')
+BLOCK_SIZE = 4096
+
+def recordDtype():
+    import numpy as np
+    return np.dtype([('time','<f8'), ('device','<u2'), ('on','i1'), ('pad','V5'),
+                     ('voltage','<f8'), ('current','<f8')])
+
+
+class PowerLogWriter:
+    """
+    Appends readings to a binary power log, creating it if needed.  Safe to share between threads.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        if not os.path.exists(fileName) or os.path.getsize(fileName) < HEADER.size:
+            with open(fileName,'wb') as f:
+                f.write(HEADER.pack(MAGIC, RECORD.size))
+            if os.path.exists(fileName+'.idx'):
+                os.remove(fileName+'.idx')
+        else:
+            _checkHeader(fileName)
+        self.count = (os.path.getsize(fileName)-HEADER.size)//RECORD.size
+        #drop a record left half written by a crash
+        with open(fileName,'r+b') as f:
+            f.truncate(HEADER.size+self.count*RECORD.size)
+        _repairIndex(fileName, self.count)
+        self.blockMin, self.blockMax = _tailRange(fileName, self.count)
+        self.log = open(fileName,'ab')
+        self.index = open(fileName+'.idx','ab')
+
+    def write(self, device, on, voltage, current, t):
+        with self.lock:
+            self.log.write(RECORD.pack(t, int(device), int(on), voltage, current))
+            self.blockMin = min(self.blockMin, t)
+            self.blockMax = max(self.blockMax, t)
+            self.count += 1
+            if self.count % BLOCK_SIZE == 0:
+                self.index.write(INDEX.pack(self.count-BLOCK_SIZE, self.blockMin, self.blockMax))
+                self.blockMin, self.blockMax = float('inf'), float('-inf')
+            self.flush()
+
+    def flush(self):
+        self.log.flush()
+        self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.log.close()
+            self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _checkHeader(fileName):
+    with open(fileName,'rb') as f:
+        magic, recordSize = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or recordSize != RECORD.size:
+        raise ValueError(f'{fileName} is not a power log')
+
+def _readIndex(fileName):
+    if not os.path.exists(fileName+'.idx'):
+        return []
+    with open(fileName+'.idx','rb') as f:
+        data = f.read()
+    return list(INDEX.iter_unpack(data[:len(data)-len(data)%INDEX.size]))
+
+def _blockRange(f, first, n):
+    f.seek(HEADER.size+first*RECORD.size)
+    data = f.read(n*RECORD.size)
+    times = [record[0] for record in RECORD.iter_unpack(data[:len(data)-len(data)%RECORD.size])]
+    return (min(times), max(times)) if times else (float('inf'), float('-inf'))
+
+def _repairIndex(fileName, count):
+    """Rewrite the index if it does not cover exactly the completed blocks of the log"""
+    indexSize = os.path.getsize(fileName+'.idx') if os.path.exists(fileName+'.idx') else 0
+    if indexSize == (count//BLOCK_SIZE)*INDEX.size:
+        return
+    with open(fileName,'rb') as f, open(fileName+'.idx','wb') as idx:
+        for block in range(count//BLOCK_SIZE):
+            idx.write(INDEX.pack(block*BLOCK_SIZE, *_blockRange(f, block*BLOCK_SIZE, BLOCK_SIZE)))
+
+def _tailRange(fileName, count):
+    first = count - count % BLOCK_SIZE
+    with open(fileName,'rb') as f:
+        return _blockRange(f, first, count-first)
+
+
+def openLog(fileName):
+    """Memory-map a power log as a read-only NumPy structured array"""
+    import numpy as np
+    _checkHeader(fileName)
+    count = (os.path.getsize(fileName)-HEADER.size)//RECORD.size
+    if count == 0:
+        return np.zeros(0, dtype=recordDtype())
+    return np.memmap(fileName, dtype=recordDtype(), mode='r', offset=HEADER.size, shape=(count,))
+
+def query(fileName, start=None, end=None, device=None):
+    """
+    Records with start <= time <= end (either bound may be None), optionally for one device.
+    Only the blocks whose indexed time range overlaps the query are read, plus the
+    unindexed tail of the log.
+    """
+    import numpy as np
+    records = openLog(fileName)
+    start = -np.inf if start is None else start
+    end = np.inf if end is None else end
+    index = _readIndex(fileName)
+    blocks = [(first, first+BLOCK_SIZE) for first,tmin,tmax in index if tmax >= start and tmin <= end]
+    blocks.append((len(index)*BLOCK_SIZE, len(records)))
+    selected = []
+    for first,last in blocks:
+        chunk = records[first:last]
+        mask = (chunk['time'] >= start) & (chunk['time'] <= end)
+        if device is not None:
+            mask &= chunk['device'] == int(device)
+        selected.append(np.array(chunk[mask]))
+    return np.concatenate(selected)
+
+
+textLine = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) (?:Board (\d+) )?Power: (On|Off), ASIC Voltage: ?([-+.\deE]+), ASIC Current: ?([-+.\deE]+)')
+
+def convertTextLog(textFile, logFile, device):
+    """
+    Append the readings of a TestStand_Controls text log (logFile.log) to a binary power log.
+    Lines from multi-board monitoring carry their own board number, other lines are logged as device.
+    Returns the number of readings converted; other lines are skipped.
+    """
+    n = 0
+    with open(textFile) as f, PowerLogWriter(logFile) as writer:
+        for line in f:
+            match = textLine.match(line)
+            if match is None:
+                continue
+            asctime, board, power, v, i = match.groups()
+            t = datetime.strptime(asctime, '%Y-%m-%d %H:%M:%S,%f').timestamp()
+            writer.write(device if board is None else int(board), power=='On', float(v), float(i), t)
+            n += 1
+    return n
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert', help='Convert a text log to the binary format')
+    convert.add_argument('textLog')
+    convert.add_argument('binaryLog')
+    convert.add_argument('--device', required=True, type=int, help='Address of the supply the text log was taken from')
+    show = subparsers.add_parser('query', help='Print the readings in a time range')
+    show.add_argument('binaryLog')
+    show.add_argument('--start', default=None, help='Start time, YYYY-mm-dd HH:MM:SS')
+    show.add_argument('--end', default=None, help='End time, YYYY-mm-dd HH:MM:SS')
+    show.add_argument('--device', default=None, type=int)
+    args = parser.parse_args()
+
+    if args.command=='convert':
+        n = convertTextLog(args.textLog, args.binaryLog, args.device)
+        print(f'Converted {n} readings')
+    else:
+        toTime = lambda s: None if s is None else datetime.strptime(s, '%Y-%m-%d %H:%M:%S').timestamp()
+        for r in query(args.binaryLog, toTime(args.start), toTime(args.end), args.device):
+            print(f'{datetime.fromtimestamp(r["time"])} {r["device"]} Power: {"On" if r["on"] else "Off"}, Voltage: {r["voltage"]:.4f}, Current: {r["current"]:.4f}')
@@ -0,0 +1,181 @@
+"""
+Declarative power supply sequences, run next to the instrument so the steps keep their timing.
+
+A sequence is a list of steps:
+    {"op": "set", "voltage": 1.2, "current": 0.6}
+    {"op": "on"}, {"op": "off"}
+    {"op": "wait", "seconds": 0.5}
+    {"op": "ramp", "from": 0.8, "to": 1.2, "steps": 8, "seconds": 2.0}
+    {"op": "verify", "voltage": 1.2, "tolerance": 0.05, "on": 1}
+"output" on a step picks the output of multi-output supplies (Agilent E3648A, TTi channels),
+and is refused on single-output supplies and on ops the driver cannot direct to one output.
+Every voltage in the sequence is checked against the supply's SAFE_VOLTAGE window before
+anything is sent, so a sequence is either refused or run from the start.
+
+    python sequence.py --ip 192.168.1.50 --addr 8 '[{"op":"set","voltage":0.8},{"op":"on"},{"op":"ramp","from":0.8,"to":1.2,"steps":4,"seconds":2}]'
+"""
+import time
+import json
+import inspect
+
+OPS = ('set', 'on', 'off', 'wait', 'ramp', 'verify')
+#keys each op needs, and the keys that have to be numbers (steps and output whole numbers)
+REQUIRED = {'set': ('voltage',), 'on': (), 'off': (), 'wait': ('seconds',),
+            'ramp': ('from', 'to', 'steps', 'seconds'), 'verify': ()}
+NUMBERS = ('voltage', 'current', 'seconds', 'from', 'to', 'steps', 'tolerance', 'output')
+INTEGERS = ('steps', 'output')
+#driver method each op calls, and the arguments it takes before the output
+METHODS = {'set': ('SetLimits', 2), 'ramp': ('SetLimits', 2), 'on': ('TurnOn', 0),
+           'off': ('TurnOff', 0), 'verify': ('ReadPower', 0)}
+
+class SequenceError(Exception):
+    """A verify step failed; the steps before it have already been run"""
+    def __init__(self, message, log):
+        Exception.__init__(self, message)
+        self.log = log
+
+
+def safeWindow(ps):
+    return getattr(ps, 'SAFE_VOLTAGE', (0.6, 1.5))
+
+def setpoints(step):
+    """Voltages a step will set, in order"""
+    if step['op']=='set':
+        return [float(step['voltage'])]
+    if step['op']=='ramp':
+        n = int(step['steps'])
+        v1, v2 = float(step['from']), float(step['to'])
+        return [round(v1+(v2-v1)*k/n, 6) for k in range(n+1)]
+    return []
+
+def parseSteps(steps):
+    """Steps from a JSON string or an already decoded list"""
+    if isinstance(steps, str):
+        steps = json.loads(steps)
+    if not isinstance(steps, list) or not all(isinstance(step, dict) for step in steps):
+        raise ValueError('A sequence is a list of steps')
+    return steps
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def takesOutput(ps, op):
+    """Whether the driver method behind op can be given an output"""
+    if op not in METHODS:
+        return False
+    name, before = METHODS[op]
+    return len(inspect.signature(getattr(ps, name)).parameters) > before
+
+def validate(ps, steps):
+    """Raise ValueError unless every step is well formed and every voltage inside the safe window of ps"""
+    low, high = safeWindow(ps)
+    for n,step in enumerate(steps):
+        op = step.get('op')
+        if op not in OPS:
+            raise ValueError(f'Step {n}: unknown op {op}')
+        missing = [key for key in REQUIRED[op] if key not in step]
+        if missing:
+            raise ValueError(f'Step {n}: {op} needs {", ".join(missing)}')
+        for key in NUMBERS:
+            if key in step and not isNumber(step[key]):
+                raise ValueError(f'Step {n}: {key} must be a number, not {step[key]!r}')
+        for key in INTEGERS:
+            if key in step and step[key] != int(step[key]):
+                raise ValueError(f'Step {n}: {key} must be a whole number, not {step[key]}')
+        if 'output' in step:
+            outputs = getattr(ps, 'OUTPUTS', 1)
+            if outputs==1:
+                raise ValueError(f'Step {n}: {type(ps).__name__} has a single output')
+            if not takesOutput(ps, op):
+                raise ValueError(f'Step {n}: {op} cannot be given an output on {type(ps).__name__}')
+            if not 1 <= step['output'] <= outputs:
+                raise ValueError(f'Step {n}: output must be 1-{outputs}, not {step["output"]}')
+        if 'on' in step and step['on'] not in (0, 1):
+            raise ValueError(f'Step {n}: on must be 0 or 1, not {step["on"]!r}')
+        if op=='ramp' and int(step['steps']) < 1:
+            raise ValueError(f'Step {n}: a ramp needs at least one step')
+        if op in ('wait','ramp') and float(step['seconds']) < 0:
+            raise ValueError(f'Step {n}: negative duration')
+        if op=='verify' and 'voltage' not in step and 'on' not in step:
+            raise ValueError(f'Step {n}: nothing to verify')
+        for v in setpoints(step):
+            if not low <= v <= high:
+                raise ValueError(f'Step {n}: voltage {v} outside of defined safe range {low}-{high}')
+
+
+def runSequence(ps, steps, call=None):
+    """
+    Validate, then run steps on ps.  Waits and ramp steps are timed from the start of the
+    sequence, so bus time does not stretch a ramp; a step that overruns delays the ones after
+    it rather than shortening the next wait.
+    Every instrument command goes through call(func), which returns func(ps); a server passes
+    one that takes the bus for that command only, so the waits do not hold it.
+    Returns a log of {'step', 'op', 't', ...} entries, t in seconds from the start.
+    """
+    validate(ps, steps)
+    if call is None:
+        call = lambda func: func(ps)
+    log = []
+    start = time.monotonic()
+    planned = 0.
+    def sleepUntil(offset):
+        delay = start+offset-time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    for n,step in enumerate(steps):
+        op = step['op']
+        output = (int(step['output']),) if 'output' in step else ()
+        current = float(step.get('current', 0.6))
+        sleepUntil(planned)
+        if op=='set':
+            call(lambda ps: ps.SetLimits(float(step['voltage']), current, *output))
+        elif op=='on':
+            call(lambda ps: ps.TurnOn(*output))
+        elif op=='off':
+            call(lambda ps: ps.TurnOff(*output))
+        elif op=='wait':
+            planned += float(step['seconds'])
+            sleepUntil(planned)
+        elif op=='ramp':
+            voltages = setpoints(step)
+            interval = float(step['seconds'])/(len(voltages)-1)
+            for k,v in enumerate(voltages):
+                sleepUntil(planned+k*interval)
+                call(lambda ps: ps.SetLimits(v, current, *output))
+            planned += float(step['seconds'])
+        entry = {'step': n, 'op': op, 't': time.monotonic()-start}
+        if op=='verify':
+            p, v, i = call(lambda ps: ps.ReadPower(*output))
+            entry.update({'on': int(p), 'voltage': float(v), 'current': float(i)})
+            log.append(entry)
+            if 'voltage' in step and abs(float(v)-float(step['voltage'])) > float(step.get('tolerance', 0.05)):
+                raise SequenceError(f'Step {n}: read {float(v)} V, expected {step["voltage"]} V', log)
+            if 'on' in step and int(p) != int(step['on']):
+                raise SequenceError(f'Step {n}: output is {"on" if int(p) else "off"}', log)
+        else:
+            log.append(entry)
+        planned = max(planned, time.monotonic()-start)
+    return log
+
+
+if __name__=='__main__':
+    import argparse
+    from PowerSupplyControls import getPowerSupply
+    parser = argparse.ArgumentParser()
+    parser.add_argument('steps', help='Sequence as a JSON list of steps, or @file to read it from a file')
+    parser.add_argument('--ip', default='192.168.1.50', help='IP Address of the gpib controller or supply')
+    parser.add_argument('--addr', default=8, type=int, help='GPIB address of the power supply')
+    args = parser.parse_args()
+
+    if args.steps.startswith('@'):
+        with open(args.steps[1:]) as f:
+            args.steps = f.read()
+    ps = getPowerSupply(args.ip, args.addr)
+    try:
+        for entry in runSequence(ps, parseSteps(args.steps)):
+            print(entry)
+    except SequenceError as e:
+        for entry in e.log:
+            print(entry)
+        print(e)
+    ps.close()
@@ -0,0 +1,55 @@
+import struct
+import threading
+from array import array
+
+# one published reading: time, output state, voltage, current
+SAMPLE_FORMAT = struct.Struct('<dbdd')
+
+def packSample(t, p, v, i):
+    return SAMPLE_FORMAT.pack(t, int(p), v, i)
+
+def unpackSample(frame):
+    return SAMPLE_FORMAT.unpack(frame)
+
+
+class RingBuffer:
+    """
+    Fixed-size history of power readings for one device.
+
+    Samples are kept in one preallocated array('d') per column (time, power, voltage,
+    current), so appending never allocates and a full buffer overwrites the oldest sample.
+    """
+    FIELDS = ('time', 'power', 'voltage', 'current')
+
+    def __init__(self, size=3600):
+        self.size = size
+        self.columns = [array('d', bytes(8*size)) for field in self.FIELDS]
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, t, p, v, i):
+        with self.lock:
+            j = self.count % self.size
+            for column,value in zip(self.columns, (t, p, v, i)):
+                column[j] = value
+            self.count += 1
+
+    def _sample(self, j):
+        t,p,v,i = (column[j] for column in self.columns)
+        return t, int(p), v, i
+
+    def latest(self):
+        """Most recent (time, power, voltage, current), or None if nothing was recorded"""
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self._sample((self.count-1) % self.size)
+
+    def last(self, n):
+        """Up to n most recent samples, oldest first"""
+        with self.lock:
+            n = min(n, len(self))
+            return [self._sample(j % self.size) for j in range(self.count-n, self.count)]